@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench.attribute.rewrite.py
+
+对比 change.gff3.add.intron.py 中 exon/CDS 的两种 ID 改写方式：
+  - parse_attributes + format_attributes（整列拆分再拼接）
+  - replace_attribute_id（只替换 ID= 字段）
+
+usage：
+  python bench.attribute.rewrite.py                       # 使用模拟的 Liftoff 属性串
+  python bench.attribute.rewrite.py -i Mo17.mapped.gff3   # 使用真实注释中的 exon/CDS 属性串
+"""
+
+import argparse
+import importlib.util
+import time
+from pathlib import Path
+
+here = Path(__file__).parent.resolve()
+
+def load_add_intron():
+    spec = importlib.util.spec_from_file_location("change_gff3_add_intron", here / "change.gff3.add.intron.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def simulated_attributes(n):
+    attrs = []
+    for i in range(n):
+        mrna = f"Zm00001eb{i // 8:06d}_T001"
+        attrs.append(
+            f"ID={mrna}.exon.{i % 8};Parent={mrna};Name={mrna}.exon.{i % 8};"
+            f"coverage=0.998;sequence_ID=0.991;valid_ORFs=1;extra_copy_number=0;"
+            f"copy_num_ID={mrna}_0;matches_ref_protein=True;partial_mapping=False;"
+            f"low_identity=False;source=Liftoff"
+        )
+    return attrs
+
+def gff3_attributes(path, limit):
+    attrs = []
+    with open(path, 'r') as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) >= 9 and fields[2] in ('exon', 'CDS'):
+                attrs.append(fields[8])
+                if len(attrs) >= limit:
+                    break
+    return attrs
+
+# 两种方式结果必须一致的属性串：ID 位置、末尾分号、无 ID、重复 ID、空列
+PARITY_CASES = [
+    "ID=a;Parent=m",
+    "ID=a;Parent=m;",
+    "Parent=m;ID=a;Name=x;",
+    "Parent=m;ID=a",
+    "Parent=m;Name=x;",
+    "Parent=m",
+    "ID=a;Parent=m;ID=b;Name=x;",
+    "ID=a;",
+    ";",
+    ".",
+    "",
+]
+
+def difference_cause(attr_str):
+    """parse/format 往返会改变的结构：空字段、不含 = 的字段、重复的键"""
+    fields = attr_str.rstrip(';').split(';')
+    if any(not f for f in fields):
+        return "empty field"
+    if any('=' not in f for f in fields):
+        return "field without '='"
+    keys = [f.split('=', 1)[0] for f in fields]
+    if len(set(keys)) != len(keys):
+        return "repeated key"
+    return "other"
+
+def time_it(func, attrs, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for i, a in enumerate(attrs):
+            func(a, f"mRNA{i}_exon1")
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark exon/CDS ID rewrite: parse/format round trip vs in-place splice")
+    ap.add_argument("-i", "--input", help="GFF3 to take exon/CDS attribute strings from (default: simulated Liftoff attributes)")
+    ap.add_argument("-n", "--number", type=int, default=200000, help="Number of attribute strings")
+    ap.add_argument("-r", "--repeat", type=int, default=5, help="Repeats (best time is reported)")
+    args = ap.parse_args()
+
+    mod = load_add_intron()
+    attrs = gff3_attributes(args.input, args.number) if args.input else simulated_attributes(args.number)
+    if not attrs:
+        raise SystemExit("[ERROR] No exon/CDS attribute strings found.")
+
+    def round_trip(attr_str, new_id):
+        parsed = mod.parse_attributes(attr_str)
+        parsed['ID'] = new_id
+        return mod.format_attributes(parsed)
+
+    for a in PARITY_CASES:
+        if round_trip(a, "new") != mod.replace_attribute_id(a, "new"):
+            raise SystemExit(f"[ERROR] parity case {a!r}: {round_trip(a, 'new')!r} != {mod.replace_attribute_id(a, 'new')!r}")
+
+    # 其余差异只来自往返会改写的结构（空字段、不含 = 的字段、重复的键），按原因计数
+    causes = {}
+    for i, a in enumerate(attrs):
+        if round_trip(a, f"mRNA{i}_exon1") != mod.replace_attribute_id(a, f"mRNA{i}_exon1"):
+            cause = difference_cause(a)
+            causes[cause] = causes.get(cause, 0) + 1
+    differ = sum(causes.values())
+
+    t_round = time_it(round_trip, attrs, args.repeat)
+    t_splice = time_it(mod.replace_attribute_id, attrs, args.repeat)
+
+    print(f"attribute strings : {len(attrs)} (avg {sum(map(len, attrs)) / len(attrs):.0f} chars)")
+    print(f"parse/format      : {t_round:.3f} s")
+    print(f"splice ID         : {t_splice:.3f} s")
+    print(f"speedup           : {t_round / t_splice:.1f}x")
+    detail = ", ".join(f"{cause}: {count}" for cause, count in sorted(causes.items()))
+    print(f"differing results : {differ}" + (f" ({detail})" if detail else ""))
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,16 @@
 import argparse
+import heapq
+import os
+import pickle
 import sys
+import tempfile
+from collections import deque
+from itertools import groupby
+from multiprocessing import Pool
+
+# 不会作为其他特征 Parent 的叶子特征类型，构建 Parent 索引时跳过以节省内存
+LEAF_FEATURE_TYPES = {'exon', 'cds', 'intron', 'five_prime_utr', 'three_prime_utr',
+                      'start_codon', 'stop_codon'}
 
 def parse_attributes(attr_str):
     attributes = {}
@@ -12,6 +23,31 @@ def parse_attributes(attr_str):
 def format_attributes(attrs):
     return ';'.join(f"{key}={value}" for key, value in attrs.items())
 
+def replace_attribute_id(attr_str, new_id):
+    """只替换第 9 列中 ID= 字段的值，其余内容原样保留（避免 parse/format 整列往返）
+
+    与 format_attributes 的结果一样只保留一个 ID：写在第一个 ID= 字段处，其后重复的 ID= 字段删除；
+    末尾的分号（不产生空字段）同样去掉。
+    """
+    attr_str = attr_str.rstrip(';')
+    if not attr_str or attr_str == '.':
+        return f"ID={new_id}"
+    if attr_str.startswith('ID='):
+        start = 3
+    else:
+        pos = attr_str.find(';ID=')
+        if pos < 0:
+            # 没有 ID 字段时追加到末尾，与 format_attributes 的结果一致
+            return f"{attr_str};ID={new_id}"
+        start = pos + 4
+    end = attr_str.find(';', start)
+    if end < 0:
+        return attr_str[:start] + new_id
+    rest = attr_str[end:]
+    if ';ID=' in rest:
+        rest = ''.join(';' + part for part in rest[1:].split(';') if not part.startswith('ID='))
+    return attr_str[:start] + new_id + rest
+
 def process_gene_module(module_lines):
     output_lines = []
     current_mrna = None
@@ -27,11 +63,10 @@ def process_gene_module(module_lines):
             
         # 检查字段数量
         if len(fields) < 9:
-            output_lines.append('\t'.join(fields))
+            output_lines.append(fields)
             continue
             
         seqid, source, feature_type, start, end, score, strand, phase, attributes_str = fields[:9]
-        attrs = parse_attributes(attributes_str)
         
         # 处理基因和mRNA
         if feature_type == 'gene' or feature_type == 'mRNA':
@@ -41,9 +76,11 @@ def process_gene_module(module_lines):
                 exons = []
                 cdss = []
             
-            output_lines.append('\t'.join(fields))
+            output_lines.append(fields)
             
-            if feature_type == 'mRNA' and 'ID' in attrs:
+            # 只有 mRNA 需要解析第 9 列取 ID
+            attrs = parse_attributes(attributes_str) if feature_type == 'mRNA' else {}
+            if 'ID' in attrs:
                 current_mrna = attrs['ID']
                 current_strand = strand
             else:
@@ -58,9 +95,9 @@ def process_gene_module(module_lines):
             elif feature_type == 'CDS':
                 cdss.append(fields)
             else:
-                output_lines.append('\t'.join(fields))
+                output_lines.append(fields)
         else:
-            output_lines.append('\t'.join(fields))
+            output_lines.append(fields)
     
     # 处理最后一个mRNA
     if current_mrna:
@@ -84,10 +121,8 @@ def process_mrna_features(output_lines, mrna_id, strand, exons, cdss):
     
     # 处理外显子
     for i, exon in enumerate(exons_sorted, 1):
-        attrs = parse_attributes(exon[8])
-        attrs['ID'] = f"{mrna_id}_exon{i}"
-        exon[8] = format_attributes(attrs)
-        output_lines.append('\t'.join(exon))
+        exon[8] = replace_attribute_id(exon[8], f"{mrna_id}_exon{i}")
+        output_lines.append(exon)
     
     # 添加内含子（需要至少2个外显子）
     if len(exons_sorted) > 1:
@@ -114,70 +149,254 @@ def process_mrna_features(output_lines, mrna_id, strand, exons, cdss):
                     '.',                 # phase
                     f'ID={mrna_id}_intron{i+1}'
                 ]
-                output_lines.append('\t'.join(intron_fields))
+                output_lines.append(intron_fields)
     
     # 处理CDS
     for i, cds in enumerate(cdss_sorted, 1):
-        attrs = parse_attributes(cds[8])
-        attrs['ID'] = f"{mrna_id}_cds{i}"
-        cds[8] = format_attributes(attrs)
-        output_lines.append('\t'.join(cds))
+        cds[8] = replace_attribute_id(cds[8], f"{mrna_id}_cds{i}")
+        output_lines.append(cds)
 
-def main():
-    parser = argparse.ArgumentParser(description='Process GFF file to add introns and rename features.')
-    parser.add_argument('-i', '--input', required=True, help='Input GFF file')
-    parser.add_argument('-o', '--output', required=True, help='Output GFF file')
-    args = parser.parse_args()
-    
-    # 读取输入文件
-    with open(args.input, 'r') as f:
-        input_lines = f.readlines()
-    
-    all_output_lines = []
+def iter_records(lines):
+    """把 GFF3 文本行解析为记录：注释行/空行原样保留为 str，特征行拆分为字段列表"""
+    for line in lines:
+        stripped = line.strip()
+        if line.startswith('#') or not stripped:
+            yield line
+        else:
+            yield stripped.split('\t')
+
+def format_record(record):
+    """把记录还原为一行 GFF3 文本（带换行符）"""
+    if isinstance(record, str):
+        return record if record.endswith('\n') else record + '\n'
+    return '\t'.join(record) + '\n'
+
+def iter_gene_modules(records):
+    """按基因模块切分记录：注释行/空行原样产出（str），基因模块产出字段列表的列表（list）"""
     current_module = []
     
-    # 按基因模块处理
-    for line in input_lines:
-        stripped = line.strip()
-        
-        # 处理注释行
-        if line.startswith('#'):
-            if current_module:
-                processed = process_gene_module(current_module)
-                all_output_lines.extend(processed)
-                current_module = []
-            all_output_lines.append(line)
-            continue
-            
-        # 处理空行
-        if not stripped:
+    for record in records:
+        # 处理注释行和空行
+        if isinstance(record, str):
             if current_module:
-                processed = process_gene_module(current_module)
-                all_output_lines.extend(processed)
+                yield current_module
                 current_module = []
-            all_output_lines.append(line)
+            yield record
             continue
-            
-        fields = stripped.split('\t')
         
-        # 发现新基因时处理当前模块
-        if len(fields) >= 3 and fields[2] == 'gene':
+        # 发现新基因时产出当前模块
+        if len(record) >= 3 and record[2] == 'gene':
             if current_module:
-                processed = process_gene_module(current_module)
-                all_output_lines.extend(processed)
-            current_module = [fields]
+                yield current_module
+            current_module = [record]
         else:
-            current_module.append(fields)
+            current_module.append(record)
     
-    # 处理最后一个模块
+    # 最后一个模块
     if current_module:
-        processed = process_gene_module(current_module)
-        all_output_lines.extend(processed)
+        yield current_module
+
+def iter_file_gene_modules(gff_file):
+    """按相邻关系切分文件中的基因模块（输入需按基因排好序）"""
+    with open(gff_file, 'r') as f:
+        yield from iter_gene_modules(iter_records(f))
+
+def build_parent_index(gff_file):
+    """第一遍扫描：记录非叶子特征的 ID -> (Parent, 位置键)、序列出现顺序以及需要保留的注释行
+
+    位置键为 (序列出现顺序, 起始坐标, 行号)，用于把输出整理为基因组顺序。
+    """
+    parent_index = {}
+    seqid_rank = {}
+    comment_lines = []
+    with open(gff_file, 'r') as f:
+        for line_no, record in enumerate(iter_records(f)):
+            if isinstance(record, str):
+                # '###' 在重新分组后失去意义，空行也不再保留
+                if record.startswith('#') and not record.startswith('###'):
+                    comment_lines.append(record)
+                continue
+            if record[0] not in seqid_rank:
+                seqid_rank[record[0]] = len(seqid_rank)
+            if len(record) < 9 or record[2].lower() in LEAF_FEATURE_TYPES:
+                continue
+            attrs = parse_attributes(record[8])
+            feature_id = attrs.get('ID')
+            if feature_id:
+                parent = attrs.get('Parent')
+                position = (seqid_rank[record[0]], _start_of(record), line_no)
+                parent_index[feature_id] = (parent.split(',')[0] if parent else None, position)
+    return parent_index, seqid_rank, comment_lines
+
+def _start_of(record):
+    try:
+        return int(record[3])
+    except (IndexError, ValueError):
+        return 0
+
+def resolve_group_key(parent_index, seqid_rank, record, line_no):
+    """沿 Parent 链找到顶层特征（基因），返回排序键 (基因位置, 转录本位置, 是否子特征, 自身位置)"""
+    parent = None
+    if len(record) >= 9:
+        parent = parse_attributes(record[8]).get('Parent')
     
-    # 写入输出文件
-    with open(args.output, 'w') as f:
-        for line in all_output_lines:
-            f.write(line + '\n' if not line.endswith('\n') else line)
+    # 自下而上收集祖先，防止 Parent 成环
+    path = []
+    seen = set()
+    current = parent.split(',')[0] if parent else None
+    while current in parent_index and current not in seen:
+        seen.add(current)
+        path.append(current)
+        current = parent_index[current][0]
+    
+    position = (seqid_rank[record[0]], _start_of(record), line_no)
+    if not path:
+        # 顶层特征（或 Parent 缺失的孤立特征）自成一个模块
+        return (position, (), 0, position)
+    root_position = parent_index[path[-1]][1]
+    if len(path) == 1:
+        # 转录本本身，排在其子特征之前
+        return (root_position, position, 0, position)
+    return (root_position, parent_index[path[-2]][1], 1, position)
+
+def _write_sorted_run(buffer, tmpdir):
+    buffer.sort(key=lambda item: item[0])
+    fd, path = tempfile.mkstemp(suffix='.run', dir=tmpdir)
+    with os.fdopen(fd, 'wb') as f:
+        for item in buffer:
+            pickle.dump(item, f, pickle.HIGHEST_PROTOCOL)
+    return path
+
+def _read_sorted_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+def iter_parent_modules(gff_file, buffer_size=500000, tmpdir=None):
+    """按 Parent 链接分组的基因模块，适用于未排序或交错的 GFF3
+
+    第一遍建立非叶子特征的 Parent 索引；第二遍为每条记录计算分组排序键，
+    每 buffer_size 条排序后写入临时文件，最后多路归并，按基因组顺序依次产出模块。
+    产出格式与 iter_gene_modules 相同：注释行在最前，其后为各基因模块。
+    """
+    parent_index, seqid_rank, comment_lines = build_parent_index(gff_file)
+    yield from comment_lines
+    
+    with tempfile.TemporaryDirectory(prefix='gff3_sort_', dir=tmpdir) as run_dir:
+        run_paths = []
+        buffer = []
+        with open(gff_file, 'r') as f:
+            for line_no, record in enumerate(iter_records(f)):
+                if isinstance(record, str):
+                    continue
+                buffer.append((resolve_group_key(parent_index, seqid_rank, record, line_no), record))
+                if len(buffer) >= buffer_size:
+                    run_paths.append(_write_sorted_run(buffer, run_dir))
+                    buffer = []
+        
+        if run_paths:
+            if buffer:
+                run_paths.append(_write_sorted_run(buffer, run_dir))
+                buffer = []
+            merged = heapq.merge(*(_read_sorted_run(p) for p in run_paths), key=lambda item: item[0])
+        else:
+            # 数据量小于缓冲区时无需落盘
+            buffer.sort(key=lambda item: item[0])
+            merged = iter(buffer)
+        
+        for _, group in groupby(merged, key=lambda item: item[0][0]):
+            yield [record for _, record in group]
+
+def process_modules(items):
+    """处理 iter_gene_modules/iter_parent_modules 产出的模块，产出结果记录"""
+    for item in items:
+        if isinstance(item, str):
+            yield item
+        else:
+            yield from process_gene_module(item)
+
+def add_introns(records):
+    """补齐 intron 并规范 exon/CDS 的 ID（可在其他脚本中直接调用）
+
+    records 为 iter_records 产出的记录；按基因模块流式处理，产出同样格式的记录。
+    """
+    return process_modules(iter_gene_modules(records))
+
+def iter_module_batches(items, batch_size):
+    """把连续的基因模块（连同其间的注释行/空行）按 batch_size 个模块打包，保持原始顺序"""
+    batch = []
+    n_modules = 0
+    for item in items:
+        batch.append(item)
+        if not isinstance(item, str):
+            n_modules += 1
+            if n_modules >= batch_size:
+                yield batch
+                batch = []
+                n_modules = 0
+    if batch:
+        yield batch
+
+def process_module_batch(batch):
+    """子进程中处理一批基因模块，返回该批输出的 GFF3 文本"""
+    output_lines = []
+    for item in batch:
+        if isinstance(item, str):
+            output_lines.append(format_record(item))
+        else:
+            output_lines.extend(format_record(r) for r in process_gene_module(item))
+    return ''.join(output_lines)
+
+def iter_output_text_parallel(items, workers, batch_size=2000):
+    """多进程处理：各批次并行计算，按输入顺序依次产出，结果与串行完全一致"""
+    # 同时在途的批次数有上限，避免读入速度超过处理速度时内存无限增长
+    max_pending = workers * 4
+    pending = deque()
+    with Pool(workers) as pool:
+        for batch in iter_module_batches(items, batch_size):
+            pending.append(pool.apply_async(process_module_batch, (batch,)))
+            if len(pending) >= max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+def main():
+    parser = argparse.ArgumentParser(description='Process GFF file to add introns and rename features.')
+    parser.add_argument('-i', '--input', required=True, help='Input GFF file')
+    parser.add_argument('-o', '--output', required=True, help='Output GFF file')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of worker processes (1 = serial streaming)')
+    parser.add_argument('--batch-size', type=int, default=2000,
+                        help='Gene modules per batch sent to a worker (used with --workers > 1)')
+    parser.add_argument('--group-by-parent', action='store_true',
+                        help='Group features by Parent= links instead of adjacency (for unsorted/interleaved GFF3)')
+    parser.add_argument('--sort-buffer', type=int, default=500000,
+                        help='Records sorted in memory before spilling a run to disk (used with --group-by-parent)')
+    parser.add_argument('--tmpdir', default=None,
+                        help='Directory for external-sort spill files (default: system temp dir)')
+    args = parser.parse_args()
+    
+    if args.workers < 1:
+        parser.error("--workers must be >= 1")
+    if args.batch_size < 1:
+        parser.error("--batch-size must be >= 1")
+    if args.sort_buffer < 1:
+        parser.error("--sort-buffer must be >= 1")
+    
+    # 逐行读取、按基因模块处理并立即写出，内存占用只取决于最大的基因模块（并行时为在途批次）
+    if args.group_by_parent:
+        items = iter_parent_modules(args.input, args.sort_buffer, args.tmpdir)
+    else:
+        items = iter_file_gene_modules(args.input)
+    
+    with open(args.output, 'w') as fout:
+        if args.workers > 1:
+            fout.writelines(iter_output_text_parallel(items, args.workers, args.batch_size))
+        else:
+            fout.writelines(format_record(r) for r in process_modules(items))
 
 if __name__ == "__main__":
     main()
@@ -1,385 +1,1044 @@
 import argparse
+import hashlib
+import importlib.util
+import json
 import os
-import matplotlib.pyplot as plt
-import pandas as pd
-from collections import defaultdict
+import sys
+import time
+from array import array
+from multiprocessing import Pool
 import numpy as np
 
-def parse_gff3(gff3_file):
-    gene_dict = {}
-    mrna_to_gene = {}
-    mrna_ids = set()  # 存储所有mRNA ID
-    
+def read_gff3_records(gff3_file):
+    """逐行读取 GFF3，跳过注释行，产出字段列表"""
     with open(gff3_file, 'r') as f:
         for line in f:
             if line.startswith('#'):
                 continue
-            fields = line.strip().split('\t')
-            if len(fields) < 9:
-                continue
-                
-            seqid = fields[0]
-            feature_type = fields[2].lower()
-            start = int(fields[3])
-            end = int(fields[4])
-            attributes = fields[8]
-            
-            attr_dict = {}
-            for attr in attributes.split(';'):
-                attr = attr.strip()
-                if '=' in attr:
-                    key, val = attr.split('=', 1)
-                    attr_dict[key] = val
-            
-            if feature_type == 'gene':
-                gene_id = attr_dict.get('ID')
-                if gene_id:
-                    gene_dict[gene_id] = {
-                        'seqid': seqid,
-                        'start': start,
-                        'end': end,
-                        'mRNAs': {}
-                    }
-                    
-            elif feature_type == 'mrna':
-                parent = attr_dict.get('Parent')
-                if not parent:
-                    continue
-                if ',' in parent:
-                    parent = parent.split(',')[0]
-                if parent in gene_dict:
-                    mrna_id = attr_dict.get('ID')
-                    if mrna_id:
-                        gene_dict[parent]['mRNAs'][mrna_id] = {
-                            'start': start,
-                            'end': end,
-                            'exons': [],
-                            'cds': [],
-                            'three_prime_utr': [],
-                            'five_prime_utr': [],
-                            'exon_details': [],
-                            'cds_details': [],
-                            'introns': []
-                        }
-                        mrna_to_gene[mrna_id] = parent
-                        mrna_ids.add(mrna_id)  # 添加到mRNA ID集合
-            
-            elif feature_type in ['exon', 'cds']:
-                parent = attr_dict.get('Parent')
-                if not parent:
-                    continue
-                if ',' in parent:
-                    parents = parent.split(',')
-                else:
-                    parents = [parent]
-                
-                for p in parents:
-                    if p in mrna_to_gene:
-                        gene_id = mrna_to_gene[p]
-                        mrna_info = gene_dict[gene_id]['mRNAs'].get(p)
-                        if mrna_info:
-                            feature_id = attr_dict.get('ID')
-                            if feature_type == 'exon':
-                                mrna_info['exons'].append((start, end))
-                                mrna_info['exon_details'].append({'start': start, 'end': end, 'id': feature_id})
-                            elif feature_type == 'cds':
-                                mrna_info['cds'].append((start, end))
-                                mrna_info['cds_details'].append({'start': start, 'end': end, 'id': feature_id})
-            
-            elif feature_type == 'five_prime_utr':
-                parent = attr_dict.get('Parent')
-                if not parent:
-                    continue
-                if ',' in parent:
-                    parents = parent.split(',')
-                else:
-                    parents = [parent]
-                
-                for p in parents:
-                    if p in mrna_to_gene:
-                        gene_id = mrna_to_gene[p]
-                        mrna_info = gene_dict[gene_id]['mRNAs'].get(p)
-                        if mrna_info:
-                            mrna_info['five_prime_utr'].append((start, end))
+            yield line.strip().split('\t')
+
+def parse_gff3(gff3_file):
+    return parse_gff3_records(read_gff3_records(gff3_file))
+
+# 特征类型编码（GeneModel.feat_type）
+EXON, CDS, FIVE_UTR, THREE_UTR, INTRON = range(5)
+FEATURE_CODES = {
+    'exon': EXON,
+    'cds': CDS,
+    'five_prime_utr': FIVE_UTR,
+    'three_prime_utr': THREE_UTR,
+    'intron': INTRON,
+}
+
+class GeneModel:
+    """列式存储的基因模型
+
+    序列名、基因 ID、mRNA ID 各只保存一份（列表下标即整数编码），
+    坐标、所属关系、特征类型等数值列存放在 NumPy 数组中；
+    exon/CDS/intron 的特征 ID 拼接存放在一个字节缓冲区中，按偏移量取回。
+    """
+    
+    ARRAY_FIELDS = [('gene_seqid', np.int32), ('gene_start', np.int64), ('gene_end', np.int64),
+                    ('mrna_gene', np.int32), ('mrna_slot', np.int32),
+                    ('mrna_start', np.int64), ('mrna_end', np.int64),
+                    ('feat_mrna', np.int32), ('feat_type', np.int8),
+                    ('feat_start', np.int64), ('feat_end', np.int64),
+                    ('feat_id_offset', np.int64)]
+    
+    def __init__(self):
+        self.seqids = []
+        self.gene_ids = []
+        self.mrna_ids = []
+        self._seqid_index = {}
+        self._gene_index = {}
+        self._mrna_index = {}
+        # 构建期间用 array 追加，finalize() 后转换为 NumPy 数组
+        self.gene_seqid = array('i')
+        self.gene_start = array('q')
+        self.gene_end = array('q')
+        self.mrna_gene = array('i')    # 所属基因下标；-1 表示已被同名基因/mRNA 覆盖
+        self.mrna_slot = array('i')    # 基因内的输出顺序（同名 mRNA 覆盖时沿用原位置）
+        self.mrna_start = array('q')
+        self.mrna_end = array('q')
+        self.feat_mrna = array('i')
+        self.feat_type = array('b')
+        self.feat_start = array('q')
+        self.feat_end = array('q')
+        self.feat_id_offset = array('q', [0])
+        self._feat_id_buf = bytearray()
+    
+    def add_gene(self, gene_id, seqid, start, end):
+        seq_idx = self._seqid_index.get(seqid)
+        if seq_idx is None:
+            seq_idx = self._seqid_index[seqid] = len(self.seqids)
+            self.seqids.append(seqid)
+        g = self._gene_index.get(gene_id)
+        if g is None:
+            self._gene_index[gene_id] = len(self.gene_ids)
+            self.gene_ids.append(sys.intern(gene_id))
+            self.gene_seqid.append(seq_idx)
+            self.gene_start.append(start)
+            self.gene_end.append(end)
+            return
+        # 同名基因再次出现：沿用原位置，坐标以新行为准，已有的 mRNA 全部作废
+        self.gene_seqid[g] = seq_idx
+        self.gene_start[g] = start
+        self.gene_end[g] = end
+        for m in np.flatnonzero(np.frombuffer(self.mrna_gene, dtype=np.int32) == g):
+            self.mrna_gene[m] = -1
+            if self._mrna_index.get(self.mrna_ids[m]) == m:
+                del self._mrna_index[self.mrna_ids[m]]
+    
+    def add_mrna(self, mrna_id, gene_id, start, end):
+        g = self._gene_index.get(gene_id)
+        if g is None:
+            return
+        m = len(self.mrna_ids)
+        slot = m
+        old = self._mrna_index.get(mrna_id)
+        if old is not None and self.mrna_gene[old] == g:
+            # 同一基因下的同名 mRNA：替换原记录，保留其输出位置
+            self.mrna_gene[old] = -1
+            slot = self.mrna_slot[old]
+        self._mrna_index[mrna_id] = m
+        self.mrna_ids.append(sys.intern(mrna_id))
+        self.mrna_gene.append(g)
+        self.mrna_slot.append(slot)
+        self.mrna_start.append(start)
+        self.mrna_end.append(end)
+    
+    def has_mrna(self, mrna_id):
+        return mrna_id in self._mrna_index
+    
+    def add_feature(self, mrna_id, feature_type, start, end, feature_id=None):
+        m = self._mrna_index.get(mrna_id)
+        if m is None:
+            return
+        self.feat_mrna.append(m)
+        self.feat_type.append(feature_type)
+        self.feat_start.append(start)
+        self.feat_end.append(end)
+        if feature_id:
+            self._feat_id_buf += feature_id.encode()
+        self.feat_id_offset.append(len(self._feat_id_buf))
+    
+    def feature_ids(self, indices):
+        """按下标批量取回特征 ID（无 ID 时为空串）"""
+        starts = self.feat_id_offset[indices].tolist()
+        ends = self.feat_id_offset[indices + 1].tolist()
+        buf = self._feat_id_buf
+        if isinstance(buf, str):
+            return [buf[a:b] for a, b in zip(starts, ends)]
+        return [buf[a:b].decode() for a, b in zip(starts, ends)]
+    
+    def derive_introns(self):
+        """为没有显式 intron 的 mRNA 由 exon 坐标推导 intron（需在 finalize() 之后调用）
+
+        规则与 change.gff3.add.intron.py 相同：exon 按起始坐标排序，相邻两个 exon 之间的间隔即 intron，
+        编号按基因组顺序，ID 为 {mRNA ID}_intron{N}（N 为相邻对的序号，相接或重叠的 exon 对不产生 intron 但占用编号）。
+        """
+        has_intron = np.bincount(self.feat_mrna[self.feat_type == INTRON], minlength=len(self.mrna_ids)) > 0
+        exon = np.flatnonzero((self.feat_type == EXON) & ~has_intron[self.feat_mrna])
+        exon = exon[np.lexsort((exon, self.feat_start[exon], self.feat_mrna[exon]))]
+        if len(exon) < 2:
+            return self
+        
+        mrna = self.feat_mrna[exon]
+        first = np.flatnonzero(np.r_[True, mrna[1:] != mrna[:-1]])
+        rank = np.arange(len(exon)) - np.repeat(first, np.diff(np.r_[first, len(exon)]))
+        start = self.feat_end[exon[:-1]] + 1
+        end = self.feat_start[exon[1:]] - 1
+        keep = np.flatnonzero((mrna[1:] == mrna[:-1]) & (start <= end))
+        mrna, start, end, number = mrna[1:][keep], start[keep], end[keep], rank[1:][keep]
+        
+        ids = [f"{self.mrna_ids[m]}_intron{n}" for m, n in zip(mrna.tolist(), number.tolist())]
+        text = ''.join(ids)
+        buf = self._feat_id_buf
+        if isinstance(buf, str) and text.isascii():
+            self._feat_id_buf = buf + text
+            lengths = list(map(len, ids))
+        else:
+            encoded = [i.encode() for i in ids]
+            self._feat_id_buf = (buf.encode() if isinstance(buf, str) else buf) + b''.join(encoded)
+            lengths = list(map(len, encoded))
+        offsets = self.feat_id_offset[-1] + np.cumsum(lengths, dtype=np.int64)
+        
+        self.feat_mrna = np.concatenate([self.feat_mrna, mrna.astype(np.int32)])
+        self.feat_type = np.concatenate([self.feat_type, np.full(len(keep), INTRON, dtype=np.int8)])
+        self.feat_start = np.concatenate([self.feat_start, start])
+        self.feat_end = np.concatenate([self.feat_end, end])
+        self.feat_id_offset = np.concatenate([self.feat_id_offset, offsets])
+        return self
+    
+    def finalize(self):
+        """把构建期间的 array 转为 NumPy 数组，并去掉已作废 mRNA 上的特征"""
+        for name, dtype in self.ARRAY_FIELDS:
+            # 与 array 共享内存，不额外复制
+            setattr(self, name, np.frombuffer(getattr(self, name), dtype=dtype))
+        # 纯 ASCII 时字节偏移即字符偏移，直接保存为 str，取 ID 时免去逐个 decode
+        self._feat_id_buf = bytes(self._feat_id_buf)
+        if self._feat_id_buf.isascii():
+            self._feat_id_buf = self._feat_id_buf.decode()
+        
+        # 输出顺序：基因按首次出现顺序，基因内 mRNA 按 slot
+        live = np.flatnonzero(self.mrna_gene >= 0)
+        self.mrna_order = live[np.lexsort((self.mrna_slot[live], self.mrna_gene[live]))]
+        self._gene_index = self._mrna_index = self._seqid_index = None
+        return self
+    
+    def save(self, path, meta):
+        """保存为 .npz（先写临时文件再改名，避免并发读到半个文件）"""
+        data = {name: getattr(self, name) for name, _ in self.ARRAY_FIELDS}
+        data['mrna_order'] = self.mrna_order
+        for name in ('seqids', 'gene_ids', 'mrna_ids'):
+            data[name] = np.frombuffer('\n'.join(getattr(self, name)).encode(), dtype=np.uint8)
+        buf = self._feat_id_buf
+        data['feat_id_buf'] = np.frombuffer(buf.encode() if isinstance(buf, str) else buf, dtype=np.uint8)
+        data['meta'] = np.array(json.dumps(meta))
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **data)
+        os.replace(tmp_path, path)
+    
+    @classmethod
+    def load(cls, path):
+        """从 save() 写出的 .npz 读回已 finalize 的模型"""
+        model = cls.__new__(cls)
+        with np.load(path) as data:
+            for name, dtype in cls.ARRAY_FIELDS:
+                setattr(model, name, data[name].astype(dtype, copy=False))
+            model.mrna_order = data['mrna_order']
+            for name in ('seqids', 'gene_ids', 'mrna_ids'):
+                text = data[name].tobytes().decode()
+                setattr(model, name, text.split('\n') if text else [])
+            buf = data['feat_id_buf'].tobytes()
+            model._feat_id_buf = buf.decode() if buf.isascii() else buf
+        model._gene_index = model._mrna_index = model._seqid_index = None
+        return model
+
+def parse_gff3_records(records):
+    """由解析后的记录（字段列表；注释行为 str 时跳过）构建列式基因模型"""
+    model = GeneModel()
+    
+    for fields in records:
+        if isinstance(fields, str):
+            continue
+        if len(fields) < 9:
+            continue
             
-            elif feature_type == 'three_prime_utr':
-                parent = attr_dict.get('Parent')
-                if not parent:
-                    continue
-                if ',' in parent:
-                    parents = parent.split(',')
-                else:
-                    parents = [parent]
+        seqid = fields[0]
+        feature_type = fields[2].lower()
+        start = int(fields[3])
+        end = int(fields[4])
+        attributes = fields[8]
+        
+        attr_dict = {}
+        for attr in attributes.split(';'):
+            attr = attr.strip()
+            if '=' in attr:
+                key, val = attr.split('=', 1)
+                attr_dict[key] = val
+        
+        if feature_type == 'gene':
+            gene_id = attr_dict.get('ID')
+            if gene_id:
+                model.add_gene(gene_id, seqid, start, end)
                 
-                for p in parents:
-                    if p in mrna_to_gene:
-                        gene_id = mrna_to_gene[p]
-                        mrna_info = gene_dict[gene_id]['mRNAs'].get(p)
-                        if mrna_info:
-                            mrna_info['three_prime_utr'].append((start, end))
+        elif feature_type == 'mrna':
+            parent = attr_dict.get('Parent')
+            if not parent:
+                continue
+            if ',' in parent:
+                parent = parent.split(',')[0]
+            mrna_id = attr_dict.get('ID')
+            if mrna_id:
+                model.add_mrna(mrna_id, parent, start, end)
+        
+        elif feature_type in ('exon', 'cds', 'five_prime_utr', 'three_prime_utr'):
+            parent = attr_dict.get('Parent')
+            if not parent:
+                continue
+            code = FEATURE_CODES[feature_type]
+            # UTR 不输出到特征表，不保存 ID
+            feature_id = attr_dict.get('ID') if code in (EXON, CDS) else None
+            for p in parent.split(','):
+                model.add_feature(p, code, start, end, feature_id)
+        
+        # 增强intron特征处理
+        elif feature_type == 'intron':
+            intron_id = attr_dict.get('ID')
+            if not intron_id:
+                continue
             
-            # 增强intron特征处理
-            elif feature_type == 'intron':
-                intron_id = attr_dict.get('ID')
-                if not intron_id:
-                    continue
-                
-                # 尝试从ID推断mRNA ID
-                mrna_id_candidate = None
-                if '_intron' in intron_id:
-                    # 从intron ID中提取mRNA ID部分
-                    mrna_id_candidate = intron_id.rsplit('_intron', 1)[0]
-                
-                # 检查候选mRNA ID是否有效
-                if mrna_id_candidate and mrna_id_candidate in mrna_ids:
-                    gene_id = mrna_to_gene.get(mrna_id_candidate)
-                    if gene_id:
-                        mrna_info = gene_dict[gene_id]['mRNAs'].get(mrna_id_candidate)
-                        if mrna_info:
-                            mrna_info['introns'].append({'start': start, 'end': end, 'id': intron_id})
+            # 从intron ID中提取mRNA ID部分，检查候选mRNA ID是否有效
+            if '_intron' in intron_id:
+                mrna_id_candidate = intron_id.rsplit('_intron', 1)[0]
+                if model.has_mrna(mrna_id_candidate):
+                    model.add_feature(mrna_id_candidate, INTRON, start, end, intron_id)
     
-    return gene_dict
+    return model.finalize()
+
+def load_add_intron():
+    """导入同目录下的 change.gff3.add.intron.py（文件名含点号，无法直接 import）"""
+    script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "change.gff3.add.intron.py")
+    spec = importlib.util.spec_from_file_location("change_gff3_add_intron", script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def write_through(records, path, format_record):
+    """边写出边传递记录，用于可选地保留补齐 intron 后的 GFF3"""
+    with open(path, "w") as fout:
+        for record in records:
+            fout.write(format_record(record))
+            yield record
+
+def process_gff3(gff3_file, prefix, add_introns=False, intron_gff=None, report=False, cache_dir=None,
+                 table_format='tsv', derive_introns=False, by_seqid=False, bin_size=None):
+    """统计一个 GFF3 并写出 3 个统计表
 
-def calculate_feature_length(feature_list):
-    return sum(end - start + 1 for start, end in feature_list)
+    add_introns=True 时输入为原始 GFF3：单次流式读取，在内存中补齐 intron、规范 exon/CDS 的 ID 后直接统计，
+    不再经过中间文件；intron_gff 给出时顺带写出补齐 intron 后的 GFF3。
+    report=True 时额外输出长度分布报告（见 write_length_report）。
+    table_format 为明细表与特征表的格式：tsv、parquet 或 feather（见 write_columnar_tables）。
+    derive_introns=True 时为没有显式 intron 的 mRNA 由 exon 坐标推导 intron（见 GeneModel.derive_introns），
+    原始 GFF3 无需经过 change.gff3.add.intron.py 即可得到逐个 intron 的统计；缓存中保存的是推导前的模型。
+    by_seqid / bin_size 给出时在同一次统计中额外写出逐条序列 / 固定窗口的汇总表（见 write_seqid_summary、write_bin_summary）。
+    cache_dir 给出时使用解析缓存（见 load_cached_model）；需要写出 intron_gff 时，只有它仍是由同一源文件写出且之后
+    未被改动（见 intron_gff_current）才使用缓存，否则重新解析并重写 intron_gff。
+    """
+    intron_gff = intron_gff if add_introns else None
+    model = None
+    if cache_dir and (not intron_gff or intron_gff_current(gff3_file, intron_gff, cache_dir)):
+        model = load_cached_model(gff3_file, add_introns, cache_dir)
+    if model is None:
+        model = parse_gff3_source(gff3_file, add_introns, intron_gff)
+        if cache_dir:
+            save_cached_model(model, gff3_file, add_introns, cache_dir)
+            if intron_gff:
+                record_intron_gff(gff3_file, intron_gff, cache_dir)
+    if derive_introns:
+        model.derive_introns()
+    write_stats(model, prefix, report, table_format, by_seqid, bin_size)
+    return model
 
-def process_gff3(gff3_file, prefix):
-    gene_dict = parse_gff3(gff3_file)
+def parse_gff3_source(gff3_file, add_introns=False, intron_gff=None):
+    if not add_introns:
+        return parse_gff3(gff3_file)
     
-    detail_file = f"{prefix}.gene.information.stat.tsv"
-    summary_file = f"{prefix}.summary.information.stat.tsv"
-    feature_file = f"{prefix}.intron.exon.cds.stat.tsv"
+    add_intron = load_add_intron()
+    with open(gff3_file, 'r') as fin:
+        records = add_intron.add_introns(add_intron.iter_records(fin))
+        if intron_gff:
+            records = write_through(records, intron_gff, add_intron.format_record)
+        return parse_gff3_records(records)
+
+# ---- 解析缓存 ----
+# 缓存目录下：index.json 记录 源文件路径 -> (大小, mtime, 内容哈希)，大小与 mtime 未变时免去重新计算哈希；
+# 每个缓存项为 {内容哈希}.{模式}.v{版本}.npz，源文件内容一变哈希随之改变，旧缓存项自然失效。
+CACHE_VERSION = 1
+CACHE_INDEX = "index.json"
+
+# 内容哈希的摘要长度与分块大小，与 merge.file.based.on.keys.py 的 HASH_DIGEST_SIZE/HASH_CHUNK_SIZE 相同
+HASH_DIGEST_SIZE = 20
+HASH_CHUNK_SIZE = 1 << 20
+
+def file_content_hash(path):
+    h = hashlib.blake2b(digest_size=HASH_DIGEST_SIZE)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _read_cache_index(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, CACHE_INDEX), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def _write_cache_index(cache_dir, index):
+    path = os.path.join(cache_dir, CACHE_INDEX)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, path)
+
+def source_fingerprint(gff3_file, cache_dir):
+    """返回 (绝对路径, 大小, mtime_ns, 内容哈希)；大小与 mtime 与索引记录一致时直接沿用记录的哈希"""
+    source = os.path.realpath(gff3_file)
+    st = os.stat(source)
+    index = _read_cache_index(cache_dir)
+    entry = index.get(source)
+    if entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+        return source, st.st_size, st.st_mtime_ns, entry['hash']
     
-    # Data for summary stats
-    gene_lengths = []
-    mrna_lengths = []
-    exon_counts = []
-    exon_total_lengths = []
-    intron_total_lengths = []
+    digest = file_content_hash(source)
+    index = _read_cache_index(cache_dir)
+    index[source] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': digest}
+    _write_cache_index(cache_dir, index)
+    return source, st.st_size, st.st_mtime_ns, digest
+
+def intron_gff_current(gff3_file, intron_gff, cache_dir):
+    """intron_gff 是否为当前源文件补齐 intron 后写出的文件且之后未被改动（大小与 mtime 未变时不重新计算哈希）"""
+    path = os.path.realpath(intron_gff)
+    entry = _read_cache_index(cache_dir).get(path)
+    if not entry or 'intron_of' not in entry or not os.path.exists(path):
+        return False
+    if entry['intron_of'] != source_fingerprint(gff3_file, cache_dir)[3]:
+        return False
+    st = os.stat(path)
+    if entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+        return True
+    if entry['size'] != st.st_size or file_content_hash(path) != entry['hash']:
+        return False
+    # 内容未变（仅 mtime 改变）：更新记录，下次不再计算哈希
+    index = _read_cache_index(cache_dir)
+    index[path] = dict(entry, mtime_ns=st.st_mtime_ns)
+    _write_cache_index(cache_dir, index)
+    return True
+
+def record_intron_gff(gff3_file, intron_gff, cache_dir):
+    """在缓存索引中记录 intron_gff 的大小、mtime、内容哈希及其源文件的内容哈希"""
+    digest = source_fingerprint(gff3_file, cache_dir)[3]
+    path = os.path.realpath(intron_gff)
+    st = os.stat(path)
+    index = _read_cache_index(cache_dir)
+    index[path] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': file_content_hash(path),
+                   'intron_of': digest}
+    _write_cache_index(cache_dir, index)
+
+def cache_entry_path(cache_dir, digest, add_introns):
+    mode = "introns" if add_introns else "plain"
+    return os.path.join(cache_dir, f"{digest}.{mode}.v{CACHE_VERSION}.npz")
+
+def load_cached_model(gff3_file, add_introns, cache_dir):
+    """按源文件内容哈希查找缓存，命中时返回 GeneModel，否则返回 None"""
+    os.makedirs(cache_dir, exist_ok=True)
+    _, _, _, digest = source_fingerprint(gff3_file, cache_dir)
+    path = cache_entry_path(cache_dir, digest, add_introns)
+    if not os.path.exists(path):
+        return None
+    try:
+        model = GeneModel.load(path)
+    except Exception as e:
+        print(f"[cache] 缓存项损坏，重新解析：{path} ({e})", file=sys.stderr)
+        return None
+    print(f"[cache] hit {gff3_file} -> {path}", file=sys.stderr)
+    return model
+
+def save_cached_model(model, gff3_file, add_introns, cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+    source, size, mtime_ns, digest = source_fingerprint(gff3_file, cache_dir)
+    meta = {'version': CACHE_VERSION, 'source': source, 'size': size, 'mtime_ns': mtime_ns,
+            'hash': digest, 'add_introns': bool(add_introns), 'created': time.time()}
+    path = cache_entry_path(cache_dir, digest, add_introns)
+    model.save(path, meta)
+    print(f"[cache] stored {gff3_file} -> {path}", file=sys.stderr)
+
+def iter_cache_entries(cache_dir):
+    """产出 (缓存项路径, 元数据, 状态)；状态为 ok / stale（源文件已改变）/ missing（源文件不存在）"""
+    if not os.path.isdir(cache_dir):
+        return
+    index = _read_cache_index(cache_dir)
+    for name in sorted(os.listdir(cache_dir)):
+        if not name.endswith('.npz'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            with np.load(path) as data:
+                meta = json.loads(str(data['meta']))
+        except Exception:
+            yield path, {}, 'broken'
+            continue
+        source = meta.get('source')
+        if not source or not os.path.exists(source):
+            status = 'missing'
+        else:
+            st = os.stat(source)
+            entry = index.get(source)
+            if st.st_size == meta['size'] and st.st_mtime_ns == meta['mtime_ns']:
+                status = 'ok'
+            elif entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+                status = 'ok' if entry['hash'] == meta['hash'] else 'stale'
+            else:
+                status = 'ok' if file_content_hash(source) == meta['hash'] else 'stale'
+        if meta.get('version') != CACHE_VERSION:
+            status = 'stale'
+        yield path, meta, status
+
+def list_cache(cache_dir):
+    print("\t".join(["entry", "status", "mode", "size_mb", "created", "source"]))
+    for path, meta, status in iter_cache_entries(cache_dir):
+        created = time.strftime("%Y-%m-%d %H:%M", time.localtime(meta['created'])) if 'created' in meta else ""
+        mode = "introns" if meta.get('add_introns') else "plain"
+        print("\t".join([os.path.basename(path), status, mode, f"{os.path.getsize(path) / 2**20:.1f}",
+                         created, meta.get('source', '')]))
+
+def prune_cache(cache_dir, max_age_days=None):
+    """删除源文件已改变/不存在/损坏的缓存项；给出 max_age_days 时同时删除更早创建的缓存项"""
+    removed = 0
+    now = time.time()
+    for path, meta, status in iter_cache_entries(cache_dir):
+        too_old = max_age_days is not None and now - meta.get('created', 0) > max_age_days * 86400
+        if status != 'ok' or too_old:
+            os.remove(path)
+            removed += 1
+            print(f"[cache] removed {os.path.basename(path)} ({'expired' if status == 'ok' else status})", file=sys.stderr)
+    # 清理索引中源文件已不存在的记录
+    index = _read_cache_index(cache_dir)
+    kept = {source: entry for source, entry in index.items() if os.path.exists(source)}
+    if len(kept) != len(index):
+        _write_cache_index(cache_dir, kept)
+    print(f"[cache] {removed} entries removed", file=sys.stderr)
+
+def compute_stats(records, prefix, report=False, table_format='tsv'):
+    """由解析后的记录统计并写出 3 个统计表（可在其他脚本中直接调用），返回基因模型"""
+    model = parse_gff3_records(records)
+    write_stats(model, prefix, report, table_format)
+    return model
+
+FEATURE_NAMES = {EXON: "exon", CDS: "cds", INTRON: "intron"}
+# 特征表中同一 mRNA 下的输出顺序：exon、cds、intron
+FEATURE_TABLE_ORDER = {EXON: 0, CDS: 1, INTRON: 2}
+
+def _safe_divide(num, den):
+    """逐元素相除，分母为 0 处结果为 0"""
+    return np.divide(num, den, out=np.zeros(len(num)), where=den > 0)
+
+def compute_mrna_stats(model):
+    """按 mRNA 分段归约，一次得到所有 mRNA 的计数、总长、均值与比例
+
+    返回 dict，各列均为按输出顺序（model.mrna_order）排列的 NumPy 数组。
+    """
+    n_mrna = len(model.mrna_ids)
+    feat_length = model.feat_end - model.feat_start + 1
+    
+    counts = {}
+    totals = {}
+    for code in FEATURE_CODES.values():
+        mask = model.feat_type == code
+        counts[code] = np.bincount(model.feat_mrna[mask], minlength=n_mrna)
+        totals[code] = np.bincount(model.feat_mrna[mask], weights=feat_length[mask],
+                                   minlength=n_mrna).astype(np.int64)
+    
+    order = model.mrna_order
+    gene = model.mrna_gene[order]
+    stats = {
+        'mrna': order,
+        'gene': gene,
+        'gene_length': model.gene_end[gene] - model.gene_start[gene] + 1,
+        'mrna_length': model.mrna_end[order] - model.mrna_start[order] + 1,
+        'exon_count': counts[EXON][order],
+        'intron_count': counts[INTRON][order],
+        'cds_count': counts[CDS][order],
+        'three_utr_count': counts[THREE_UTR][order],
+        'five_utr_count': counts[FIVE_UTR][order],
+        'exon_total_length': totals[EXON][order],
+        'cds_total_length': totals[CDS][order],
+        'three_utr_total_length': totals[THREE_UTR][order],
+        'five_utr_total_length': totals[FIVE_UTR][order],
+    }
     
-    # Data for boxplots and histograms
-    gene_lengths_bp = []
-    mrna_lengths_bp = []
-    exon_total_per_mrna = []
-    intron_total_per_mrna = []
+    # 如果没有直接解析到intron，则通过exon计算
+    intron_total = totals[INTRON][order]
+    no_intron = (intron_total == 0) & (stats['exon_count'] > 1)
+    stats['intron_total_length'] = np.where(no_intron, stats['mrna_length'] - stats['exon_total_length'], intron_total)
     
-    # Data for histograms
-    all_gene_lengths = []
-    all_intron_lengths = []
-    all_exon_lengths = []
-    all_mrna_lengths = []
+    # Average lengths
+    for name in ('exon', 'intron', 'cds', 'three_utr', 'five_utr'):
+        stats[f'{name}_avg_length'] = _safe_divide(stats[f'{name}_total_length'], stats[f'{name}_count'])
     
-    processed_genes = set()
+    # Intron ratios
+    stats['intron_per_mrna'] = _safe_divide(stats['intron_total_length'], stats['mrna_length'])
+    stats['intron_per_gene'] = _safe_divide(stats['intron_total_length'], stats['gene_length'])
+    stats['feature_counts'] = counts
+    return stats
+
+def feature_table_order(model):
+    """特征表的行顺序：按 mRNA 输出顺序，其内依次为 exon、cds、intron，同类保持输入顺序；跳过无 ID 的特征"""
+    mrna_rank = np.full(len(model.mrna_ids), -1, dtype=np.int64)
+    mrna_rank[model.mrna_order] = np.arange(len(model.mrna_order))
+    type_rank = np.full(len(FEATURE_CODES), -1, dtype=np.int64)
+    for code, rank in FEATURE_TABLE_ORDER.items():
+        type_rank[code] = rank
     
+    feat_rank = mrna_rank[model.feat_mrna]
+    feat_type_rank = type_rank[model.feat_type]
+    has_id = np.diff(model.feat_id_offset) > 0
+    sel = np.flatnonzero((feat_rank >= 0) & (feat_type_rank >= 0) & has_id)
+    return sel[np.lexsort((sel, feat_type_rank[sel], feat_rank[sel]))]
+
+# 分块格式化输出，避免一次生成整张表的字符串
+WRITE_CHUNK = 200000
+
+def _str_column(values):
+    return list(map(str, values.tolist()))
+
+def _float_column(values, digits):
+    fmt = f"{{:.{digits}f}}".format
+    return list(map(fmt, values.tolist()))
+
+def _write_table(f, n_rows, build_columns):
+    """按 WRITE_CHUNK 行一块，由 build_columns(slice) 生成各列字符串并写出"""
+    for lo in range(0, n_rows, WRITE_CHUNK):
+        columns = build_columns(slice(lo, lo + WRITE_CHUNK))
+        f.writelines("\t".join(row) + "\n" for row in zip(*columns))
+
+def write_text_tables(model, stats, sel, detail_file, feature_file):
+    gene = stats['gene']
     with open(detail_file, 'w') as f_detail, open(feature_file, 'w') as f_feature:
         # 写入特征文件表头
-        feature_headers = [
-            "chr_id", "start", "end", "feature_id", "feature_type",
-            "gene_id", "mrna_id", "exon_count", "cds_count", "intron_count", "length"
-        ]
-        f_feature.write("\t".join(feature_headers) + "\n")
+        f_feature.write("\t".join(FEATURE_HEADERS) + "\n")
         
         # 原有detail文件表头
-        detail_headers = [
-            "seqid", "gene_start", "gene_end", "gene_id", "gene_length",
-            "mrna_id", "mrna_length", "exon_count", "intron_count", "cds_count",
-            "three_utr_count", "five_utr_count", "exon_total_length", "intron_total_length",
-            "cds_total_length", "three_utr_total_length", "five_utr_total_length",
-            "exon_avg_length", "intron_avg_length", "cds_avg_length", "three_utr_avg_length",
-            "five_utr_avg_length", "intron_per_mrna", "intron_per_gene"
-        ]
-        f_detail.write("\t".join(detail_headers) + "\n")
+        f_detail.write("\t".join(DETAIL_HEADERS) + "\n")
         
-        for gene_id, gene_info in gene_dict.items():
-            seqid = gene_info['seqid']
-            gene_start = gene_info['start']
-            gene_end = gene_info['end']
-            gene_length = gene_end - gene_start + 1
-            
-            if gene_id not in processed_genes:
-                gene_lengths.append(gene_length)
-                gene_lengths_bp.append(gene_length)
-                all_gene_lengths.append(gene_length)
-                processed_genes.add(gene_id)
-            
-            for mrna_id, mrna_info in gene_info['mRNAs'].items():
-                mrna_start = mrna_info['start']
-                mrna_end = mrna_info['end']
-                mrna_length = mrna_end - mrna_start + 1
-                mrna_lengths.append(mrna_length)
-                mrna_lengths_bp.append(mrna_length)
-                all_mrna_lengths.append(mrna_length)
-                
-                # Feature counts
-                exon_count = len(mrna_info['exons'])
-                cds_count = len(mrna_info['cds'])
-                three_utr_count = len(mrna_info['three_prime_utr'])
-                five_utr_count = len(mrna_info['five_prime_utr'])
-                intron_count = len(mrna_info['introns'])  # 直接从introns列表获取
-                
-                # Total lengths
-                exon_total = calculate_feature_length(mrna_info['exons'])
-                cds_total = calculate_feature_length(mrna_info['cds'])
-                three_utr_total = calculate_feature_length(mrna_info['three_prime_utr'])
-                five_utr_total = calculate_feature_length(mrna_info['five_prime_utr'])
-                intron_total = calculate_feature_length([(i['start'], i['end']) for i in mrna_info['introns']])
-                
-                # 如果没有直接解析到intron，则通过exon计算
-                if intron_total == 0 and exon_count > 1:
-                    intron_total = mrna_length - exon_total
-                
-                exon_total_per_mrna.append(exon_total)
-                intron_total_per_mrna.append(intron_total)
-                exon_counts.append(exon_count)
-                exon_total_lengths.append(exon_total)
-                intron_total_lengths.append(intron_total)
-                
-                # Collect exon and intron lengths for histograms
-                for exon in mrna_info['exons']:
-                    all_exon_lengths.append(exon[1] - exon[0] + 1)
-                
-                # Calculate intron lengths
-                sorted_exons = sorted(mrna_info['exons'], key=lambda x: x[0])
-                for i in range(len(sorted_exons) - 1):
-                    intron_length = sorted_exons[i+1][0] - sorted_exons[i][1] - 1
-                    if intron_length > 0:
-                        all_intron_lengths.append(intron_length)
-                
-                # Average lengths
-                exon_avg = exon_total / exon_count if exon_count > 0 else 0
-                intron_avg = intron_total / intron_count if intron_count > 0 else 0
-                cds_avg = cds_total / cds_count if cds_count > 0 else 0
-                three_utr_avg = three_utr_total / three_utr_count if three_utr_count > 0 else 0
-                five_utr_avg = five_utr_total / five_utr_count if five_utr_count > 0 else 0
-                
-                # Intron ratios
-                intron_per_mrna = intron_total / mrna_length if mrna_length > 0 else 0
-                intron_per_gene = intron_total / gene_length if gene_length > 0 else 0
-                
-                # Write detail row
-                row = [
-                    seqid, str(gene_start), str(gene_end), gene_id, str(gene_length),
-                    mrna_id, str(mrna_length), str(exon_count), str(intron_count), str(cds_count),
-                    str(three_utr_count), str(five_utr_count), str(exon_total), str(intron_total),
-                    str(cds_total), str(three_utr_total), str(five_utr_total),
-                    f"{exon_avg:.2f}", f"{intron_avg:.2f}", f"{cds_avg:.2f}", 
-                    f"{three_utr_avg:.2f}", f"{five_utr_avg:.2f}",
-                    f"{intron_per_mrna:.4f}", f"{intron_per_gene:.4f}"
-                ]
-                f_detail.write("\t".join(row) + "\n")
-                
-                # 写入特征统计信息
-                # 处理exon特征
-                for exon in mrna_info['exon_details']:
-                    if exon['id']:
-                        length = exon['end'] - exon['start'] + 1
-                        feature_row = [
-                            seqid,
-                            str(exon['start']),
-                            str(exon['end']),
-                            exon['id'],
-                            "exon",
-                            gene_id,
-                            mrna_id,
-                            str(exon_count),
-                            str(cds_count),
-                            str(intron_count),
-                            str(length)
-                        ]
-                        f_feature.write("\t".join(feature_row) + "\n")
-                
-                # 处理cds特征
-                for cds in mrna_info['cds_details']:
-                    if cds['id']:
-                        length = cds['end'] - cds['start'] + 1
-                        feature_row = [
-                            seqid,
-                            str(cds['start']),
-                            str(cds['end']),
-                            cds['id'],
-                            "cds",
-                            gene_id,
-                            mrna_id,
-                            str(exon_count),
-                            str(cds_count),
-                            str(intron_count),
-                            str(length)
-                        ]
-                        f_feature.write("\t".join(feature_row) + "\n")
-                
-                # 处理intron特征
-                for intron in mrna_info['introns']:
-                    if intron['id']:
-                        length = intron['end'] - intron['start'] + 1
-                        feature_row = [
-                            seqid,
-                            str(intron['start']),
-                            str(intron['end']),
-                            intron['id'],
-                            "intron",
-                            gene_id,
-                            mrna_id,
-                            str(exon_count),
-                            str(cds_count),
-                            str(intron_count),
-                            str(length)
-                        ]
-                        f_feature.write("\t".join(feature_row) + "\n")
+        # Write detail rows
+        def detail_columns(sl):
+            g = gene[sl]
+            columns = [
+                [model.seqids[s] for s in model.gene_seqid[g].tolist()],
+                _str_column(model.gene_start[g]),
+                _str_column(model.gene_end[g]),
+                [model.gene_ids[i] for i in g.tolist()],
+                _str_column(stats['gene_length'][sl]),
+                [model.mrna_ids[m] for m in stats['mrna'][sl].tolist()],
+            ]
+            columns += [_str_column(stats[name][sl]) for name in DETAIL_HEADERS[6:17]]
+            columns += [_float_column(stats[name][sl], 2) for name in DETAIL_HEADERS[17:22]]
+            columns += [_float_column(stats[name][sl], 4) for name in DETAIL_HEADERS[22:]]
+            return columns
+        
+        _write_table(f_detail, len(gene), detail_columns)
+        
+        # 写入特征统计信息
+        counts = stats['feature_counts']
+        
+        def feature_columns(sl):
+            idx = sel[sl]
+            feat_mrna = model.feat_mrna[idx]
+            feat_gene = model.mrna_gene[feat_mrna]
+            return [
+                [model.seqids[s] for s in model.gene_seqid[feat_gene].tolist()],
+                _str_column(model.feat_start[idx]),
+                _str_column(model.feat_end[idx]),
+                model.feature_ids(idx),
+                [FEATURE_NAMES[t] for t in model.feat_type[idx].tolist()],
+                [model.gene_ids[g] for g in feat_gene.tolist()],
+                [model.mrna_ids[m] for m in feat_mrna.tolist()],
+                _str_column(counts[EXON][feat_mrna]),
+                _str_column(counts[CDS][feat_mrna]),
+                _str_column(counts[INTRON][feat_mrna]),
+                _str_column(model.feat_end[idx] - model.feat_start[idx] + 1),
+            ]
+        
+        _write_table(f_feature, len(sel), feature_columns)
+
+def write_columnar_tables(model, stats, sel, detail_file, feature_file, table_format):
+    """以 Parquet/Feather 写出明细表与特征表（需要 pyarrow）
+
+    列名与 TSV 相同；坐标、计数、长度为 int64，均值与比例为 float64（取值与 TSV 中的文本一致，小数位数记录在字段
+    元数据 digits 中，读取端据此还原与 TSV 相同的文本），
+    seqid、基因/mRNA ID 与特征类型为字典编码，直接由 GeneModel 的编号数组构建，不经过字符串拼接。
+    """
+    import pyarrow as pa
     
-    # Calculate summary statistics
-    num_genes = len(gene_lengths)
-    num_mrnas = len(mrna_lengths)
-    avg_gene_len = sum(gene_lengths) / num_genes if num_genes > 0 else 0
-    avg_mrna_len = sum(mrna_lengths) / num_mrnas if num_mrnas > 0 else 0
-    avg_exon_count = sum(exon_counts) / num_mrnas if num_mrnas > 0 else 0
-    avg_intron_count = sum(intron_total_lengths) / num_mrnas if num_mrnas > 0 else 0
+    seqids = pa.array(model.seqids, type=pa.string())
+    gene_ids = pa.array(model.gene_ids, type=pa.string())
+    mrna_ids = pa.array(model.mrna_ids, type=pa.string())
+    
+    def encoded(indices, dictionary):
+        return pa.DictionaryArray.from_arrays(pa.array(indices, type=pa.int32()), dictionary)
+    
+    gene = stats['gene']
+    detail = {
+        'seqid': encoded(model.gene_seqid[gene], seqids),
+        'gene_start': model.gene_start[gene],
+        'gene_end': model.gene_end[gene],
+        'gene_id': encoded(gene, gene_ids),
+        'gene_length': stats['gene_length'],
+        'mrna_id': mrna_ids.take(pa.array(stats['mrna'])),
+    }
+    detail.update((name, stats[name]) for name in DETAIL_HEADERS[6:17])
+    digits = dict.fromkeys(DETAIL_HEADERS[17:22], 2)
+    digits.update(dict.fromkeys(DETAIL_HEADERS[22:], 4))
+    # 取 TSV 写出的文本对应的值（先 np.round 再格式化会二次舍入，与 TSV 差一位）
+    detail.update((name, np.array(_float_column(stats[name], n), dtype=np.float64)) for name, n in digits.items())
+    table = pa.table(detail)
+    schema = pa.schema([field.with_metadata({'digits': str(digits[field.name])}) if field.name in digits else field
+                        for field in table.schema])
+    _write_arrow_table(table.cast(schema), detail_file, table_format)
+    
+    counts = stats['feature_counts']
+    feat_mrna = model.feat_mrna[sel]
+    feat_gene = model.mrna_gene[feat_mrna]
+    type_names = sorted(FEATURE_TABLE_ORDER, key=FEATURE_TABLE_ORDER.get)
+    type_rank = np.zeros(len(FEATURE_CODES), dtype=np.int32)
+    for code, rank in FEATURE_TABLE_ORDER.items():
+        type_rank[code] = rank
+    feature = {
+        'chr_id': encoded(model.gene_seqid[feat_gene], seqids),
+        'start': model.feat_start[sel],
+        'end': model.feat_end[sel],
+        'feature_id': pa.array(model.feature_ids(sel), type=pa.string()),
+        'feature_type': encoded(type_rank[model.feat_type[sel]],
+                                pa.array([FEATURE_NAMES[code] for code in type_names], type=pa.string())),
+        'gene_id': encoded(feat_gene, gene_ids),
+        'mrna_id': encoded(feat_mrna, mrna_ids),
+        'exon_count': counts[EXON][feat_mrna],
+        'cds_count': counts[CDS][feat_mrna],
+        'intron_count': counts[INTRON][feat_mrna],
+        'length': model.feat_end[sel] - model.feat_start[sel] + 1,
+    }
+    _write_arrow_table(pa.table(feature), feature_file, table_format)
+
+def _write_arrow_table(table, path, table_format):
+    if table_format == 'parquet':
+        import pyarrow.parquet as pq
+        pq.write_table(table, path)
+    else:
+        import pyarrow.feather as feather
+        feather.write_feather(table, path)
+
+FEATURE_HEADERS = [
+    "chr_id", "start", "end", "feature_id", "feature_type",
+    "gene_id", "mrna_id", "exon_count", "cds_count", "intron_count", "length"
+]
+DETAIL_HEADERS = [
+    "seqid", "gene_start", "gene_end", "gene_id", "gene_length",
+    "mrna_id", "mrna_length", "exon_count", "intron_count", "cds_count",
+    "three_utr_count", "five_utr_count", "exon_total_length", "intron_total_length",
+    "cds_total_length", "three_utr_total_length", "five_utr_total_length",
+    "exon_avg_length", "intron_avg_length", "cds_avg_length", "three_utr_avg_length",
+    "five_utr_avg_length", "intron_per_mrna", "intron_per_gene"
+]
+# 明细表与特征表的输出格式（文件扩展名即格式名）；汇总表总是 TSV
+TABLE_FORMATS = ('tsv', 'parquet', 'feather')
+
+def write_stats(model, prefix, report=False, table_format='tsv', by_seqid=False, bin_size=None):
+    detail_file = f"{prefix}.gene.information.stat.{table_format}"
+    summary_file = f"{prefix}.summary.information.stat.tsv"
+    feature_file = f"{prefix}.intron.exon.cds.stat.{table_format}"
     
-    total_exon_len = sum(exon_total_lengths)
-    total_exon_count = sum(exon_counts)
-    avg_exon_len = total_exon_len / total_exon_count if total_exon_count > 0 else 0
+    stats = compute_mrna_stats(model)
+    sel = feature_table_order(model)
+    if table_format == 'tsv':
+        write_text_tables(model, stats, sel, detail_file, feature_file)
+    else:
+        write_columnar_tables(model, stats, sel, detail_file, feature_file, table_format)
+    
+    # Calculate summary statistics
+    metrics = summary_metrics(model, stats, np.zeros(len(model.gene_ids), dtype=np.int64), 1)
+    row = [prefix] + [column[0] for column in _summary_columns(metrics)]
+    headers = list(SUMMARY_HEADERS)
     
-    total_intron_len = sum(intron_total_lengths)
-    total_intron_count = total_exon_count - num_mrnas
-    avg_intron_len = total_intron_len / total_intron_count if total_intron_count > 0 else 0
+    # 长度分布：固定分箱直方图，按分位数补充汇总列并出图
+    if report:
+        histograms = length_histograms(model, stats)
+        for name, hist in histograms.items():
+            for q in REPORT_QUANTILES:
+                headers.append(f"{name}_length_p{q}")
+                row.append(f"{hist.quantile(q / 100):.2f}")
+        write_length_report(histograms, prefix)
     
     # Write summary file
     with open(summary_file, 'w') as f_summary:
-        headers = ["sample", "num_genes", "avg_gene_length", "avg_mrna_length", 
-                   "avg_exon_length", "avg_exon_count", "avg_intron_length", "avg_intron_count"]
         f_summary.write("\t".join(headers) + "\n")
-        row = [
-            prefix, str(num_genes), f"{avg_gene_len:.2f}", f"{avg_mrna_len:.2f}",
-            f"{avg_exon_len:.2f}", f"{avg_exon_count:.2f}", f"{avg_intron_len:.2f}", f"{avg_intron_count:.2f}"
-        ]
         f_summary.write("\t".join(row) + "\n")
     
+    if by_seqid:
+        write_seqid_summary(model, stats, f"{prefix}.seqid.summary.stat.tsv")
+    if bin_size:
+        write_bin_summary(model, stats, bin_size, f"{prefix}.bin.summary.stat.tsv")
+
+SUMMARY_HEADERS = ["sample", "num_genes", "avg_gene_length", "avg_mrna_length",
+                   "avg_exon_length", "avg_exon_count", "avg_intron_length", "avg_intron_count"]
+
+def summary_metrics(model, stats, gene_group, n_groups):
+    """按分组归约汇总表各列（gene_group 为每个基因所属的组号），返回 SUMMARY_HEADERS[1:] 顺序的数组
+
+    全基因组汇总即只有一个组的特例；与原公式一致，avg_intron_count 为每个 mRNA 的 intron 总长。
+    """
+    mrna_group = gene_group[stats['gene']]
+    
+    def total(values, groups):
+        return np.bincount(groups, weights=values, minlength=n_groups)
+    
+    num_genes = np.bincount(gene_group, minlength=n_groups)
+    num_mrnas = np.bincount(mrna_group, minlength=n_groups)
+    exon_count = total(stats['exon_count'], mrna_group)
+    intron_length = total(stats['intron_total_length'], mrna_group)
+    return [
+        num_genes,
+        _safe_divide(total(model.gene_end - model.gene_start + 1, gene_group), num_genes),
+        _safe_divide(total(stats['mrna_length'], mrna_group), num_mrnas),
+        _safe_divide(total(stats['exon_total_length'], mrna_group), exon_count),
+        _safe_divide(exon_count, num_mrnas),
+        _safe_divide(intron_length, exon_count - num_mrnas),
+        _safe_divide(intron_length, num_mrnas),
+    ]
+
+def _summary_columns(metrics, rows=slice(None)):
+    return [_str_column(metrics[0][rows])] + [_float_column(values[rows], 2) for values in metrics[1:]]
+
+def write_seqid_summary(model, stats, path):
+    """逐条序列的汇总表：与全基因组汇总同列，第一列为 seqid（按首次出现顺序）"""
+    metrics = summary_metrics(model, stats, model.gene_seqid.astype(np.int64), len(model.seqids))
+    rows = np.flatnonzero(metrics[0] > 0)
+    columns = [[model.seqids[s] for s in rows.tolist()]] + _summary_columns(metrics, rows)
+    with open(path, 'w') as f:
+        f.write("\t".join(["seqid"] + SUMMARY_HEADERS[1:]) + "\n")
+        f.writelines("\t".join(row) + "\n" for row in zip(*columns))
+
+def write_bin_summary(model, stats, bin_size, path):
+    """固定窗口的汇总表：基因按起始坐标落入 [bin_start, bin_end] 窗口，只输出含基因的窗口"""
+    window = (model.gene_start - 1) // bin_size
+    n_windows = int(window.max()) + 1 if len(window) else 1
+    keys, gene_group = np.unique(model.gene_seqid.astype(np.int64) * n_windows + window, return_inverse=True)
+    metrics = summary_metrics(model, stats, gene_group.ravel(), len(keys))
+    seqid, window = np.divmod(keys, n_windows)
+    columns = [
+        [model.seqids[s] for s in seqid.tolist()],
+        _str_column(window * bin_size + 1),
+        _str_column((window + 1) * bin_size),
+    ] + _summary_columns(metrics)
+    with open(path, 'w') as f:
+        f.write("\t".join(["seqid", "bin_start", "bin_end"] + SUMMARY_HEADERS[1:]) + "\n")
+        f.writelines("\t".join(row) + "\n" for row in zip(*columns))
+# --report 写入汇总表的百分位
+REPORT_QUANTILES = (5, 25, 50, 75, 95)
+
+class LengthHistogram:
+    """固定对数分箱的长度直方图（1 bp ~ 1e9 bp，每个数量级 BINS_PER_DECADE 个箱）
+
+    内存占用恒定，与特征数量无关；分位数在箱内按几何插值估计，相对误差小于一个箱宽（约 5%）。
+    """
+    
+    BINS_PER_DECADE = 50
+    MAX_DECADE = 9
+    EDGES = np.logspace(0, MAX_DECADE, MAX_DECADE * BINS_PER_DECADE + 1)
+    
+    def __init__(self):
+        # counts[0] 为 < 1 bp，counts[-1] 为 >= 1e9 bp，counts[i] 对应 [EDGES[i-1], EDGES[i])
+        self.counts = np.zeros(len(self.EDGES) + 1, dtype=np.int64)
+        self.n = 0
+        self.min = None
+        self.max = None
+    
+    def add(self, values):
+        values = np.asarray(values)
+        if not len(values):
+            return
+        idx = np.searchsorted(self.EDGES, values, side='right')
+        self.counts += np.bincount(idx, minlength=len(self.counts))
+        self.n += len(values)
+        vmin, vmax = values.min(), values.max()
+        self.min = vmin if self.min is None else min(self.min, vmin)
+        self.max = vmax if self.max is None else max(self.max, vmax)
+    
+    def quantile(self, q):
+        if self.n == 0:
+            return 0
+        target = q * self.n
+        cum = np.cumsum(self.counts)
+        i = min(int(np.searchsorted(cum, target, side='left')), len(self.counts) - 1)
+        if i == 0 or i == len(self.counts) - 1:
+            value = self.min if i == 0 else self.max
+        else:
+            before = cum[i - 1]
+            frac = (target - before) / self.counts[i] if self.counts[i] else 0
+            lo, hi = self.EDGES[i - 1], self.EDGES[i]
+            value = lo * (hi / lo) ** frac
+        return float(min(max(value, self.min), self.max))
+
+def length_histograms(model, stats):
+    """基因、mRNA、exon、intron 长度直方图"""
+    histograms = {name: LengthHistogram() for name in ('gene', 'mrna', 'exon', 'intron')}
+    histograms['gene'].add(model.gene_end - model.gene_start + 1)
+    histograms['mrna'].add(stats['mrna_length'])
+    
+    exon_sel = np.flatnonzero((model.feat_type == EXON) & (model.mrna_gene[model.feat_mrna] >= 0))
+    histograms['exon'].add(model.feat_end[exon_sel] - model.feat_start[exon_sel] + 1)
+    # 按基因组顺序排好的相邻 exon 之间的间隔即 intron 长度
+    exon_sel = exon_sel[np.lexsort((model.feat_start[exon_sel], model.feat_mrna[exon_sel]))]
+    same_mrna = model.feat_mrna[exon_sel][1:] == model.feat_mrna[exon_sel][:-1]
+    gaps = model.feat_start[exon_sel][1:] - model.feat_end[exon_sel][:-1] - 1
+    histograms['intron'].add(gaps[same_mrna & (gaps > 0)])
+    return histograms
+
+def write_length_report(histograms, prefix):
+    """写出直方图计数表 {prefix}.length.histogram.tsv 和分布图 {prefix}.length.distribution.pdf"""
+    edges = LengthHistogram.EDGES
+    with open(f"{prefix}.length.histogram.tsv", 'w') as f:
+        f.write("\t".join(["bin_start", "bin_end"] + list(histograms)) + "\n")
+        for i in range(1, len(edges)):
+            counts = [int(h.counts[i]) for h in histograms.values()]
+            if any(counts):
+                f.write("\t".join([f"{edges[i - 1]:.2f}", f"{edges[i]:.2f}"] + [str(c) for c in counts]) + "\n")
+    
+    # matplotlib 仅在需要出图时导入
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    
+    names = list(histograms)
+    fig, axes = plt.subplots(1, len(names) + 1, figsize=(4 * (len(names) + 1), 3.5))
+    for ax, name in zip(axes, names):
+        hist = histograms[name]
+        ax.stairs(hist.counts[1:-1], edges, fill=True, color="#5494BE")
+        ax.set_xscale("log")
+        ax.set_title(f"{name} length (n={hist.n})")
+        ax.set_xlabel("bp")
+    
+    # 箱线图由分位数直接构造：箱为 P25-P75，须为 P5-P95
+    box_stats = []
+    for name in names:
+        hist = histograms[name]
+        if hist.n == 0:
+            continue
+        box_stats.append({
+            'label': name,
+            'whislo': hist.quantile(0.05), 'q1': hist.quantile(0.25), 'med': hist.quantile(0.5),
+            'q3': hist.quantile(0.75), 'whishi': hist.quantile(0.95), 'fliers': [],
+        })
+    ax = axes[-1]
+    if box_stats:
+        ax.bxp(box_stats, showfliers=False)
+    ax.set_yscale("log")
+    ax.set_title("length (P5/P25/P50/P75/P95)")
+    ax.set_ylabel("bp")
+    fig.tight_layout()
+    fig.savefig(f"{prefix}.length.distribution.pdf")
+    plt.close(fig)
+
+def read_config(config_file):
+    """读取配置文件：每行 sample gff3_path"""
+    samples = []
+    with open(config_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            parts = line.split()
+            if len(parts) < 2:
+                continue
+            samples.append((parts[0], parts[1]))
+    return samples
+
+def run_sample(task):
+    """处理一个样本（可在子进程中运行），返回 (sample, 汇总行, 错误信息)
+
+    task 为 (sample, gff3_path, options)，options 为传给 process_gff3 的关键字参数。
+    """
+    sample, gff3_path, options = task
+    try:
+        process_gff3(gff3_path, sample, **options)
+        with open(f"{sample}.summary.information.stat.tsv", 'r') as f:
+            f.readline()
+            row = f.readline().rstrip("\n").split("\t")
+        return sample, row, None
+    except Exception as e:
+        return sample, None, f"{type(e).__name__}: {e}"
+
+def process_config(config_file, jobs=1, **options):
+    """按配置文件处理多个样本，jobs > 1 时多进程并行；最后打印所有样本的汇总表
+
+    options 原样传给每个样本的 process_gff3（add_introns、report、cache_dir 等）。
+    """
+    samples = read_config(config_file)
+    tasks = [(sample, gff3_path, options) for sample, gff3_path in samples]
+    results = {}
+    
+    if jobs > 1 and len(tasks) > 1:
+        with Pool(min(jobs, len(tasks))) as pool:
+            for sample, row, error in pool.imap_unordered(run_sample, tasks):
+                results[sample] = (row, error)
+                print(f"[{'done' if error is None else 'FAILED'}] {sample}", file=sys.stderr)
+    else:
+        for task in tasks:
+            sample, row, error = run_sample(task)
+            results[sample] = (row, error)
+            print(f"[{'done' if error is None else 'FAILED'}] {sample}", file=sys.stderr)
+    
+    # 汇总表按配置文件顺序输出
+    headers = list(SUMMARY_HEADERS)
+    if options.get('report'):
+        headers += [f"{name}_length_p{q}" for name in ('gene', 'mrna', 'exon', 'intron') for q in REPORT_QUANTILES]
+    print("\t".join(headers))
+    failed = []
+    for sample, gff3_path in samples:
+        row, error = results[sample]
+        if error is None:
+            print("\t".join(row))
+        else:
+            failed.append((sample, gff3_path, error))
+    
+    for sample, gff3_path, error in failed:
+        print(f"错误：样本 {sample} ({gff3_path}) 处理失败：{error}", file=sys.stderr)
+    return not failed
 
 def main():
     parser = argparse.ArgumentParser(description='Process GFF3 files and generate statistics.')
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('-c', '--config', help='Configuration file with sample and GFF3 paths')
     group.add_argument('-g', '--gff3', help='Single GFF3 file to process')
+    group.add_argument('--cache-list', action='store_true', help='List parse cache entries in --cache-dir and exit')
+    group.add_argument('--cache-prune', action='store_true',
+                       help='Remove stale/broken cache entries (and entries older than --max-age) from --cache-dir')
     parser.add_argument('-p', '--prefix', help='Output prefix (used with -g)')
+    parser.add_argument('--add-introns', action='store_true',
+                        help='Input is a raw GFF3: add introns and normalize exon/CDS IDs in memory before the statistics')
+    parser.add_argument('--derive-introns', action='store_true',
+                        help='Derive introns from the sorted exon coordinates of mRNAs that have no explicit intron features')
+    parser.add_argument('--intron-gff', help='Also write the intron-annotated GFF3 here (used with -g --add-introns)')
+    parser.add_argument('--report', action='store_true',
+                        help='Add length percentile columns to the summary and write a length histogram table and PDF')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of samples processed in parallel (used with -c)')
+    parser.add_argument('--cache-dir', help='Directory of the parsed-annotation cache (keyed by file content hash)')
+    parser.add_argument('--format', choices=TABLE_FORMATS, default='tsv',
+                        help='Format of the gene detail and feature tables (parquet/feather need pyarrow)')
+    parser.add_argument('--by-seqid', action='store_true',
+                        help='Also write a per-seqid summary table (<prefix>.seqid.summary.stat.tsv)')
+    parser.add_argument('--bin-size', type=int,
+                        help='Also write a summary per fixed genomic window of this size in bp, genes binned by start '
+                             '(<prefix>.bin.summary.stat.tsv)')
+    parser.add_argument('--max-age', type=float, help='With --cache-prune: also remove entries older than this many days')
     
     args = parser.parse_args()
     
+    if args.jobs < 1:
+        parser.error("--jobs must be >= 1")
+    if args.bin_size is not None and args.bin_size < 1:
+        parser.error("--bin-size must be >= 1")
+    if args.intron_gff and not (args.gff3 and args.add_introns):
+        parser.error("--intron-gff requires -g and --add-introns")
+    if (args.cache_list or args.cache_prune) and not args.cache_dir:
+        parser.error("--cache-list/--cache-prune require --cache-dir")
+    if args.format != 'tsv':
+        try:
+            import pyarrow
+        except ImportError:
+            parser.error(f"--format {args.format} requires pyarrow (pip install pyarrow)")
+    
+    options = dict(add_introns=args.add_introns, report=args.report, cache_dir=args.cache_dir,
+                   table_format=args.format, derive_introns=args.derive_introns,
+                   by_seqid=args.by_seqid, bin_size=args.bin_size)
+    
     if args.config:
-        with open(args.config, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                parts = line.split()
-                if len(parts) < 2:
-                    continue
-                sample = parts[0]
-                gff3_path = parts[1]
-                process_gff3(gff3_path, sample)
-                
+        if not process_config(args.config, args.jobs, **options):
+            sys.exit(1)
+    
     elif args.gff3:
         if not args.prefix:
             parser.error("Prefix (-p) is required when using -g")
-        process_gff3(args.gff3, args.prefix)
+        process_gff3(args.gff3, args.prefix, intron_gff=args.intron_gff, **options)
+    
+    elif args.cache_list:
+        list_cache(args.cache_dir)
+    
+    elif args.cache_prune:
+        prune_cache(args.cache_dir, args.max_age)
 
 if __name__ == "__main__":
     main()
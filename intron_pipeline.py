@@ -12,6 +12,8 @@ intron_pipeline.py  (relative-path edition)
 """
 
 import argparse
+import importlib.util
+import json
 import os
 import sys
 import shutil
@@ -31,9 +33,109 @@ def run_cmd(args_list, cwd=None):
     if result.returncode != 0:
         sys.exit(result.returncode)
 
+def load_script(script_path):
+    """以模块方式导入脚本（文件名含点号，无法直接 import）"""
+    script_path = Path(script_path)
+    module_name = script_path.stem.replace(".", "_")
+    spec = importlib.util.spec_from_file_location(module_name, script_path)
+    module = importlib.util.module_from_spec(spec)
+    # 注册到 sys.modules：进程池按模块名序列化其中的函数（如以模块方式调用 merge 的 --jobs）
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def run_main(module, argv):
+    """以模块方式调用脚本的 main(argv)，不再启动新的解释器；脚本以非零状态退出时整个流程随之退出"""
+    print(f"[run/api] {module.__name__}.main {' '.join(map(str, argv))}")
+    try:
+        module.main(argv)
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            sys.exit(e.code)
+
 def which(bin_name):
     return shutil.which(bin_name)
 
+# -------- Stage manifest --------
+STAGES = ["liftoff", "stat", "rewrite", "merge", "diff", "plot"]
+MANIFEST_VERSION = 2
+
+class StageManifest:
+    """
+    各阶段的运行记录（{sample}.liftoff/{sample}.pipeline.manifest.json）：输入文件的大小、mtime、内容哈希，参数与输出路径。
+    输入哈希与参数均未变、输出仍在时跳过该阶段；force_from 及其之后的阶段总是重跑。
+    输入的大小与 mtime 与记录一致时直接沿用记录的哈希，不重新读取文件。
+    file_hash 为 merge 脚本的 file_content_hash，与键值索引、解析缓存使用同一种哈希。
+    """
+    def __init__(self, path, file_hash, force_from=None):
+        self.path = Path(path)
+        self.file_hash = file_hash
+        self.force_index = STAGES.index(force_from) if force_from else len(STAGES)
+        self.pending = {}
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            self.stages = data["stages"] if data.get("version") == MANIFEST_VERSION else {}
+        except (OSError, ValueError, KeyError):
+            self.stages = {}
+
+    def save(self):
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "stages": self.stages}, f, indent=2)
+        os.replace(tmp, self.path)
+
+    def fingerprint(self, path):
+        """返回 (绝对路径, {size, mtime_ns, hash})；任一阶段记录中同一文件的大小与 mtime 未变时沿用其哈希"""
+        path = str(Path(path).resolve())
+        st = os.stat(path)
+        for record in self.stages.values():
+            entry = record["inputs"].get(path)
+            if entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+                return path, entry
+        return path, {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "hash": self.file_hash(path)}
+
+    def up_to_date(self, name, inputs, params):
+        """判断阶段是否可以跳过；需要重跑时先删除旧记录（阶段中途失败不会留下与输出不符的记录）"""
+        signature = {"inputs": dict(self.fingerprint(p) for p in inputs), "params": params}
+        record = self.stages.get(name)
+        if (STAGES.index(name) < self.force_index and record is not None
+                and {p: e["hash"] for p, e in record["inputs"].items()}
+                == {p: e["hash"] for p, e in signature["inputs"].items()}
+                and record["params"] == params
+                and all(Path(p).exists() for p in record["outputs"])):
+            print(f"[skip] {name}：输入与参数未变（{self.path.name}）")
+            if record["inputs"] != signature["inputs"]:
+                # 内容未变（仅 mtime 改变）：更新记录，下次不再计算哈希
+                record["inputs"] = signature["inputs"]
+                self.save()
+            return True
+        if record is not None:
+            del self.stages[name]
+            self.save()
+        self.pending[name] = signature
+        return False
+
+    def record(self, name, outputs):
+        """阶段成功完成后写入记录"""
+        self.stages[name] = dict(self.pending.pop(name), outputs=[str(p) for p in outputs])
+        self.save()
+
+def liftoff_scores(gff_path):
+    """读取 Liftoff 注释中 mRNA 的 coverage 与 sequence_ID 属性：mRNA ID -> (coverage, sequence_ID)"""
+    scores = {}
+    with open(gff_path, "r") as fin:
+        for line in fin:
+            if line.startswith("#"):
+                continue
+            cols = line.rstrip("\n").split("\t")
+            if len(cols) < 9 or cols[2] not in ("mRNA", "transcript"):
+                continue
+            attrs = dict(item.split("=", 1) for item in cols[8].split(";") if "=" in item)
+            if "ID" in attrs:
+                scores[attrs["ID"]] = (attrs.get("coverage", "NA"), attrs.get("sequence_ID", "NA"))
+    return scores
+
 def parse_args():
     ap = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     ap.add_argument("--sample", required=True, help="Sample（file-prefix）")
@@ -47,9 +149,23 @@ def parse_args():
     ap.add_argument("--ref-gff", help="B73 参考注释（含 intron 的 gff3），liftoff -g 输入")
     ap.add_argument("--liftoff-mapped-gff", help="liftoff 输出的 *.mapped.gff3_polished 或等价文件（作为 change.gff3.add.intron 的输入）")
     # combine & plot
-    ap.add_argument("--ref-feature-tsv", dest="ref_feature_tsv", required=True, help="B73 端 intron/exon/cds 特征统计 TSV（合并参考文件）")
+    ap.add_argument("--ref-feature-tsv", dest="ref_feature_tsv", required=True, help="B73 端 intron/exon/cds 特征统计表（合并参考文件；TSV 或 gff.stat.py --format 输出的 .parquet/.feather）")
     ap.add_argument("--skip-plot", action="store_true", help="仅生成 TSV，不绘图")
     ap.add_argument("--threads", type=int, default=8, help="liftoff 线程数（仅在 --run-liftoff 生效）")
+    ap.add_argument("--keep-intron-gff", action="store_true", help="同时写出补齐 intron 后的 GFF3（默认仅在内存中传递）")
+    ap.add_argument("--cache-dir", help="GFF3 解析缓存目录（按文件内容哈希命中，源文件改变自动失效）")
+    ap.add_argument("--table-format", choices=["tsv", "parquet", "feather"], default="tsv",
+                    help="目标端特征统计表的格式（parquet/feather 需要 pyarrow）")
+    ap.add_argument("--on-duplicate", choices=["all", "first", "best", "aggregate"], default="all",
+                    help="Liftoff 额外拷贝去掉后缀后同一 key 对应多行目标端记录时的合并方式"
+                         "（best 按拷贝 mRNA 的 coverage、sequence_ID 选一行；见 merge.file.based.on.keys.py --on-duplicate）")
+    ap.add_argument("--exec-mode", choices=["inprocess", "subprocess"], default="inprocess",
+                    help="gff.stat / merge / plot 各阶段的执行方式：inprocess 以模块方式在当前解释器中调用"
+                         "（补 intron 后的记录直接在内存中交给统计）；subprocess 为每个阶段启动独立的 python 进程")
+    ap.add_argument("--force-from", choices=STAGES,
+                    help="从指定阶段起强制重跑（默认按 {sample}.pipeline.manifest.json 跳过输入与参数未变的阶段）："
+                         + " -> ".join(STAGES))
+    ap.add_argument("--force", action="store_true", help="忽略阶段记录，全部重跑（等同 --force-from liftoff）")
     return ap.parse_args()
 
 def main():
@@ -63,6 +179,10 @@ def main():
     liftoff_dir = workdir / f"{args.sample}.liftoff"
     liftoff_dir.mkdir(parents=True, exist_ok=True)
     os.chdir(liftoff_dir)
+    merge = load_script(script_dir / "merge.file.based.on.keys.py")
+    manifest = StageManifest(f"{args.sample}.pipeline.manifest.json", merge.file_content_hash,
+                             force_from=STAGES[0] if args.force else args.force_from)
+    pipeline_script = Path(__file__).resolve()
 
     # 1) Liftoff（可选）
     mapped_polished = None
@@ -83,7 +203,11 @@ def main():
             f"-g {args.ref_gff} -m {args.minimap2_bin} -polish -cds "
             f"-o {mapped} -u {unmapped} {args.target_fasta} {args.ref_fasta}"
         )
-        run_sh(cmd)
+        if not manifest.up_to_date("liftoff", [args.ref_gff, args.target_fasta, args.ref_fasta],
+                                   {"liftoff_bin": args.liftoff_bin, "minimap2_bin": args.minimap2_bin}):
+            run_sh(cmd)
+            polished = Path(str(mapped) + "_polished")
+            manifest.record("liftoff", [polished if polished.exists() else mapped, unmapped])
 
         mapped_polished = str(mapped) + "_polished"
         if not Path(mapped_polished).exists():
@@ -95,109 +219,168 @@ def main():
         if not Path(mapped_polished).exists():
             sys.exit(f"找不到 liftoff 映射注释：{mapped_polished}")
 
-    # 2) 添加 intron
+    # 2) 添加 intron + 3) 统计：单次流式读取，在内存中补齐 intron 后直接统计，不再写出并重读中间 GFF3
     gff_with_intron = f"{args.sample}.liftoff.B73.mapped.gff3_polished.gff3"
-    run_cmd(["python", str(script_dir / "change.gff3.add.intron.py"),
-             "-i", mapped_polished, "-o", gff_with_intron])
-
-    # 3) 统计
-    run_cmd(["python", str(script_dir / "gff.stat.py"),
-             "-g", gff_with_intron, "-p", f"{args.sample}.liftoff"])
+    feature_stat = f"{args.sample}.liftoff.intron.exon.cds.stat.{args.table_format}"
+    stat_inputs = [mapped_polished, script_dir / "gff.stat.py", script_dir / "change.gff3.add.intron.py"]
+    stat_params = {"keep_intron_gff": args.keep_intron_gff, "table_format": args.table_format}
+    if manifest.up_to_date("stat", stat_inputs, stat_params):
+        pass
+    elif args.exec_mode == "subprocess":
+        stat_cmd = ["python", str(script_dir / "gff.stat.py"),
+                    "-g", mapped_polished, "-p", f"{args.sample}.liftoff", "--add-introns"]
+        if args.keep_intron_gff:
+            stat_cmd += ["--intron-gff", gff_with_intron]
+        if args.cache_dir:
+            stat_cmd += ["--cache-dir", args.cache_dir]
+        if args.table_format != "tsv":
+            stat_cmd += ["--format", args.table_format]
+        run_cmd(stat_cmd)
+    else:
+        gff_stat = load_script(script_dir / "gff.stat.py")
+        print(f"[run/api] gff.stat.process_gff3(add_introns=True): {mapped_polished} -> {args.sample}.liftoff")
+        gff_stat.process_gff3(mapped_polished, f"{args.sample}.liftoff", add_introns=True,
+                              intron_gff=gff_with_intron if args.keep_intron_gff else None,
+                              cache_dir=args.cache_dir, table_format=args.table_format)
 
-    feature_stat = f"{args.sample}.liftoff.intron.exon.cds.stat.tsv"
     if not Path(feature_stat).exists():
         sys.exit(f"未找到特征统计文件：{feature_stat}")
+    if "stat" in manifest.pending:
+        manifest.record("stat", [feature_stat] + ([gff_with_intron] if args.keep_intron_gff else []))
 
-    # 4) 重写 4/6/7 列
+    # 4) 重写 4/6/7 列（列式表经 merge 脚本的 ColumnarTable 按列读出）
     change_tsv = f"{args.sample}.liftoff.intron.exon.cds.stat.change.tsv"
-    with open(feature_stat, "r") as fin, open(change_tsv, "w") as fout:
-        header = fin.readline().rstrip("\n").split("\t")
-        fout.write("\t".join(header) + "\n")
-        for line in fin:
-            cols = line.rstrip("\n").split("\t")
-            def get_or_blank(i):
-                return cols[i] if i < len(cols) else ""
+    rewrite_inputs = [feature_stat, pipeline_script] + ([mapped_polished] if args.on_duplicate == "best" else [])
+    if not manifest.up_to_date("rewrite", rewrite_inputs, {"on_duplicate": args.on_duplicate}):
+        # --on-duplicate best：在末尾追加该行所属拷贝 mRNA 的 coverage、sequence_ID，供合并时打分
+        scores = liftoff_scores(mapped_polished) if args.on_duplicate == "best" else None
+        with merge.open_input_file(feature_stat) as table, open(change_tsv, "w") as fout:
+            # 列式表直接按列取各行的值，不再拼接成文本行后重新拆分
+            if isinstance(table, merge.ColumnarTable):
+                rows = table.rows()
+            else:
+                rows = (line.rstrip("\n").split("\t") for line in table)
+            header = next(rows)
+            if scores is not None:
+                header += ["coverage", "sequence_ID"]
+            fout.write("\t".join(header) + "\n")
+            for cols in rows:
+                def get_or_blank(i):
+                    return cols[i] if i < len(cols) else ""
 
-            f4 = get_or_blank(3)
-            parts4 = f4.split("_")
-            f4_new = f"{parts4[0]}_{parts4[1]}_{parts4[-1]}" if len(parts4) >= 3 else f4
+                f4 = get_or_blank(3)
+                parts4 = f4.split("_")
+                f4_new = f"{parts4[0]}_{parts4[1]}_{parts4[-1]}" if len(parts4) >= 3 else f4
 
-            f6 = get_or_blank(5)
-            f6_new = f6.split("_")[0] if f6 else f6
+                f6 = get_or_blank(5)
+                f6_new = f6.split("_")[0] if f6 else f6
 
-            f7 = get_or_blank(6)
-            p7 = f7.split("_")
-            f7_new = f"{p7[0]}_{p7[1]}" if len(p7) >= 2 else f7
+                f7 = get_or_blank(6)
+                p7 = f7.split("_")
+                f7_new = f"{p7[0]}_{p7[1]}" if len(p7) >= 2 else f7
 
-            cols[3] = f4_new
-            if len(cols) >= 6:
-                cols[5] = f6_new
-            if len(cols) >= 7:
-                cols[6] = f7_new
-            fout.write("\t".join(cols) + "\n")
+                cols[3] = f4_new
+                if len(cols) >= 6:
+                    cols[5] = f6_new
+                if len(cols) >= 7:
+                    cols[6] = f7_new
+                if scores is not None:
+                    cols += scores.get(f7, ("NA", "NA"))
+                fout.write("\t".join(cols) + "\n")
+        manifest.record("rewrite", [change_tsv])
+    # 目标端列数（best 时含追加的 coverage、sequence_ID 两列）；跳过本阶段时从已有表头得到
+    with open(change_tsv, "r") as fin:
+        target_width = len(fin.readline().rstrip("\n").split("\t"))
 
     # 5) 合并（以第4列为 key）
-    run_cmd([
-        "python", str(script_dir / "merge.file.based.on.keys.py"),
+    merge_argv = [
         "-rf", change_tsv, "-rc", "4",
         "-qf", args.ref_feature_tsv, "-qc", "4",
         "-pf", f"{args.sample}.liftoff.B73"
-    ])
-
+    ]
+    if args.on_duplicate != "all":
+        merge_argv += ["--on-duplicate", args.on_duplicate]
+    if args.on_duplicate == "best":
+        merge_argv += ["--score-columns", f"{target_width - 1},{target_width}"]
     combined_tsv = f"{args.sample}.liftoff.B73.combine.file.tsv"
+    merge_inputs = [change_tsv, args.ref_feature_tsv, script_dir / "merge.file.based.on.keys.py"]
+    if manifest.up_to_date("merge", merge_inputs, {"argv": merge_argv}):
+        pass
+    elif args.exec_mode == "subprocess":
+        run_cmd(["python", str(script_dir / "merge.file.based.on.keys.py")] + merge_argv)
+    else:
+        run_main(merge, merge_argv)
+
     if not Path(combined_tsv).exists():
         sys.exit("未找到合并输出 .combine.file.tsv")
+    if "merge" in manifest.pending:
+        manifest.record("merge", [combined_tsv])
 
     # 6) 筛选等位内含子并计算长度差
     equal_intron = f"{args.sample}.liftoff.B73.combine.equal.intron.dif.tsv"
-    with open(combined_tsv, "r") as fin, open(equal_intron, "w") as fout:
-        for raw in fin:
-            row = raw.rstrip("\n").split("\t")
-            if len(row) < 14:
-                continue
-            if row[4] != "intron":
-                continue
-            picked = row[0:7] + row[9:14] + row[20:]
-            if len(picked) < 10:
-                continue
-            if picked[7] == picked[-2]:
-                try:
-                    length = int(picked[-1]) - int(picked[8])
-                except ValueError:
+    in_plot = f"{args.sample}.chr.tsv"
+    if not manifest.up_to_date("diff", [combined_tsv, pipeline_script], {"target_width": target_width}):
+        with open(combined_tsv, "r") as fin, open(equal_intron, "w") as fout:
+            for raw in fin:
+                row = raw.rstrip("\n").split("\t")
+                if len(row) < target_width + 3:
+                    continue
+                if row[4] != "intron":
                     continue
-                fout.write("\t".join(picked + [str(length)]) + "\n")
+                # 目标端 target_width 列在前（默认 11 列；best 时多出 coverage、sequence_ID 两列），B73 端在后
+                picked = row[0:7] + row[9:11] + row[target_width:target_width + 3] + row[target_width + 9:]
+                if len(picked) < 10:
+                    continue
+                if picked[7] == picked[-2]:
+                    try:
+                        length = int(picked[-1]) - int(picked[8])
+                    except ValueError:
+                        continue
+                    fout.write("\t".join(picked + [str(length)]) + "\n")
 
-    # 7) 规范化到作图输入并绘图
-    in_plot = f"{args.sample}.chr.tsv"
-    with open(in_plot, "w") as fout, open(equal_intron, "r") as fin:
-        fout.write("\t".join([
-            "seqid","gene_start","gene_end","mRNA_id","type","gene_id",
-            "mRNA_id_dup","exon_number","length.bp",
-            "ref_chr_id","ref_gene_start","ref_gene_end","ref_exon_number","ref_length.bp",
-            "dif.length.bp"
-        ]) + "\n")
-        for line in fin:
-            cols = line.rstrip("\n").split("\t")
-            if len(cols) < 15:
-                cols = cols + [""]*(15-len(cols))
-            row = [
-                cols[0], cols[1], cols[2],
-                cols[3], cols[4], cols[5],
-                cols[6], cols[7],
-                cols[9] if len(cols)>9 else "",
-                cols[10] if len(cols)>10 else "",
-                cols[11] if len(cols)>11 else "",
-                cols[12] if len(cols)>12 else "",
-                cols[-3] if len(cols)>3 else "",
-                cols[-2] if len(cols)>2 else "",
-                cols[-1],
-            ]
-            fout.write("\t".join(row) + "\n")
+        # 7) 规范化到作图输入
+        with open(in_plot, "w") as fout, open(equal_intron, "r") as fin:
+            fout.write("\t".join([
+                "seqid","gene_start","gene_end","mRNA_id","type","gene_id",
+                "mRNA_id_dup","exon_number","length.bp",
+                "ref_chr_id","ref_gene_start","ref_gene_end","ref_exon_number","ref_length.bp",
+                "dif.length.bp"
+            ]) + "\n")
+            for line in fin:
+                cols = line.rstrip("\n").split("\t")
+                if len(cols) < 15:
+                    cols = cols + [""]*(15-len(cols))
+                row = [
+                    cols[0], cols[1], cols[2],
+                    cols[3], cols[4], cols[5],
+                    cols[6], cols[7],
+                    cols[9] if len(cols)>9 else "",
+                    cols[10] if len(cols)>10 else "",
+                    cols[11] if len(cols)>11 else "",
+                    cols[12] if len(cols)>12 else "",
+                    cols[-3] if len(cols)>3 else "",
+                    cols[-2] if len(cols)>2 else "",
+                    cols[-1],
+                ]
+                fout.write("\t".join(row) + "\n")
+        manifest.record("diff", [equal_intron, in_plot])
 
+    # 8) 绘图
     if not args.skip_plot:
         pdf = f"{args.sample}_Intron_Diff_ByChr_Horizontal_PosNeg.pdf"
-        run_cmd(["python", str(script_dir / "plot_introns_v2.py"),
-                 "-i", in_plot, "-o", pdf])
+        plot_argv = ["-i", in_plot, "-o", pdf]
+        if not manifest.up_to_date("plot", [in_plot, script_dir / "plot_introns_v2.py"], {"argv": plot_argv}):
+            plot = None
+            if args.exec_mode == "inprocess":
+                try:
+                    plot = load_script(script_dir / "plot_introns_v2.py")
+                except ImportError as e:
+                    print(f"[WARN] 无法以模块方式载入绘图脚本（{e}），改用子进程")
+            if plot is not None:
+                run_main(plot, plot_argv)
+            else:
+                run_cmd(["python", str(script_dir / "plot_introns_v2.py")] + plot_argv)
+            manifest.record("plot", [pdf])
         print(f"[OK] Plot saved -> {pdf}")
     print("[DONE]")
 
@@ -3,9 +3,24 @@
 
 import sys
 import argparse
+from array import array
 from collections import defaultdict
+import gc
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import mmap
 import os
+import pickle
 import re
+import shutil
+import struct
+import tempfile
+from itertools import groupby
+from multiprocessing import get_all_start_methods, get_context
+from operator import itemgetter
 
 def parse_column_spec(spec):
     """解析列规范字符串（如'1,3'或'1-3'），返回从0开始的列索引列表"""
@@ -21,185 +36,1219 @@ def parse_column_spec(spec):
             indices.append(int(part.strip())-1)  # 从1开始的索引转为0开始
     return sorted(set(indices))  # 去重并排序
 
-def check_columns_in_file(file_obj, column_indices, file_name, file_type, delimiter):
-    """检查文件是否包含所有指定的列索引"""
-    file_obj.seek(0)
-    found_valid_line = False
+# gff.stat.py --format parquet/feather 输出的列式表
+COLUMNAR_SUFFIXES = {'.parquet': 'parquet', '.feather': 'feather'}
+
+class ColumnarTable:
+    """读取 Parquet/Feather 表，可与普通文件对象互换使用（迭代时产出以制表符分隔的文本行，首行为表头）
+
+    各列按记录批次直接由 pyarrow 读取：整数列与字典编码列整列转为文本（字典只转换一次），
+    浮点列按字段元数据 digits 记录的小数位数以与 TSV 相同的格式输出；keyed_lines / rows
+    直接取各列的值，不再拼接后重新拆分。
+    """
     
-    for line in file_obj:
-        stripped = line.strip()
-        if not stripped or stripped.startswith('#'):
-            continue
-            
-        # 分割行 - 根据分隔符类型
-        if delimiter == "whitespace":
-            parts = re.split(r'\s+', stripped)
-        else:
-            parts = stripped.split(delimiter)
-        
-        # 检查所有列索引是否都存在
-        if all(idx < len(parts) for idx in column_indices):
-            found_valid_line = True
-            break
+    def __init__(self, path, table_format):
+        self.name = path
+        self.table_format = table_format
+    
+    def _batches(self):
+        if self.table_format == 'parquet':
+            import pyarrow.parquet as pq
+            pf = pq.ParquetFile(self.name)
+            return pf.schema_arrow, pf.iter_batches()
+        import pyarrow as pa
+        reader = pa.ipc.open_file(self.name)
+        return reader.schema, (reader.get_batch(i) for i in range(reader.num_record_batches))
+    
+    def read_table(self):
+        """整表读入为 pyarrow.Table"""
+        if self.table_format == 'parquet':
+            import pyarrow.parquet as pq
+            return pq.read_table(self.name)
+        import pyarrow.feather as feather
+        return feather.read_table(self.name)
+    
+    @staticmethod
+    def text_columns(batch):
+        """一个记录批次的各列文本（pyarrow 字符串数组，空值为空字符串），写出时才格式化"""
+        return [_text_column(column, field) for field, column in zip(batch.schema, batch.columns)]
+    
+    def _text_batches(self):
+        schema, batches = self._batches()
+        return schema.names, (self.text_columns(batch) for batch in batches)
     
-    file_obj.seek(0)
-    return found_valid_line
+    def __iter__(self):
+        names, batches = self._text_batches()
+        yield "\t".join(names) + "\n"
+        for columns in batches:
+            for line in _join_columns(columns).to_pylist():
+                yield line + "\n"
+    
+    def rows(self):
+        """逐行产出各列的值（字符串列表，首行为表头）"""
+        names, batches = self._text_batches()
+        yield list(names)
+        for columns in batches:
+            for row in zip(*(column.to_pylist() for column in columns)):
+                yield list(row)
+    
+    def keyed_lines(self, key_indices):
+        """产出 (行, 键)：键直接取自键值列；表头、缺少键值列、首尾有空白、空行与注释行的键为 None（按文本规则处理）"""
+        names, batches = self._text_batches()
+        yield "\t".join(names), None
+        for columns in batches:
+            lines = _join_columns(columns)
+            if max(key_indices) >= len(columns):
+                for line in lines.to_pylist():
+                    yield line, None
+                continue
+            keys = zip(*(columns[idx].to_pylist() for idx in key_indices))
+            for line, key, ok in zip(lines.to_pylist(), keys, _plain_rows(columns).to_pylist()):
+                yield line, (key if ok else None)
+    
+    def close(self):
+        pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
 
-def process_reference_file(file_obj, key_indices, delimiter):
-    """处理参考文件，返回字典和错误行（支持多列键值）"""
-    ref_dict = defaultdict(list)
-    blank_lines = []
-    comment_lines = []
-    error_lines = []
-    unmatched_lines = []
-    total_lines = 0
-    valid_lines = 0
-    collected_keys = []  # 收集前三个不同的键
-    seen_keys = set()
+def _text_column(column, field):
+    """把一列转为字符串数组：浮点列按字段元数据 digits（gff.stat.py 写出列式表时记录的 TSV 小数位数）格式化"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    if pa.types.is_dictionary(column.type):
+        return pc.fill_null(_text_column(column.dictionary, field).take(column.indices), "")
+    digits = (field.metadata or {}).get(b'digits')
+    if digits is not None:
+        fmt = f"{{:.{int(digits)}f}}".format
+        text = pa.array([None if value is None else fmt(value) for value in column.to_pylist()], pa.string())
+    elif pa.types.is_integer(column.type) or pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        text = pc.cast(column, pa.string())
+    else:
+        text = pa.array([None if value is None else str(value) for value in column.to_pylist()], pa.string())
+    return pc.fill_null(text, "")
+
+def _plain_rows(columns):
+    """各行是否为普通数据行（非空、不以 # 开头、首尾无空白），只有这些行的键值可直接取自键值列"""
+    import pyarrow.compute as pc
+    # 行首尾是否有空白只取决于首列与末列；首列为空时行以制表符开头，同样不算
+    first, last = columns[0], columns[-1]
+    return pc.and_(pc.and_(pc.greater(pc.utf8_length(first), 0), pc.invert(pc.starts_with(first, "#"))),
+                   pc.and_(pc.equal(pc.utf8_ltrim_whitespace(first), first),
+                           pc.equal(pc.utf8_rtrim_whitespace(last), last)))
+
+def _join_columns(columns):
+    """各列文本以制表符连接为行"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    if len(columns) == 1:
+        return columns[0]
+    return pc.binary_join_element_wise(*columns, pa.scalar("\t", columns[0].type))
+
+class StdinReader:
+    """标准输入的包装：用法与文件对象相同，但 with 结束时不关闭 sys.stdin
+    （同一进程中之后仍可读取标准输入，如以模块方式多次调用 main，或多个查询都指定为 '-'）"""
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        return False
+    
+    def close(self):
+        pass
+    
+    def __iter__(self):
+        return iter(sys.stdin)
     
+    def __getattr__(self, name):
+        return getattr(sys.stdin, name)
+
+def open_input_file(path):
+    """打开输入文件，只做一次顺序读取：
+
+    '-' 为标准输入；.gz/.zst 边读边解压（.zst 需要 zstandard）；.parquet/.feather 按列式表读取（需要 pyarrow）；
+    其余（含命名管道）按文本文件打开。
+    """
+    if path == '-':
+        return StdinReader()
+    lower = path.lower()
+    suffix = os.path.splitext(lower)[1]
+    if suffix in COLUMNAR_SUFFIXES:
+        try:
+            import pyarrow  # 检查可选依赖
+        except ImportError:
+            raise ImportError(f"读取 {path} 需要 pyarrow（pip install pyarrow）")
+        return ColumnarTable(path, COLUMNAR_SUFFIXES[suffix])
+    if suffix == '.gz':
+        return gzip.open(path, 'rt')
+    if suffix == '.zst':
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(f"读取 {path} 需要 zstandard（pip install zstandard）")
+        return zstandard.open(path, 'rt')
+    return open(path, 'r')
+
+def split_fields(stripped, delimiter):
+    """按分隔符拆分一行（whitespace 表示任意空白）"""
+    if delimiter == "whitespace":
+        return re.split(r'\s+', stripped)
+    return stripped.split(delimiter)
+
+def new_counts():
+    """单个输入文件的行计数（只计数，不保存行内容）；keys/matched_keys 为唯一键值数与匹配键值数"""
+    return {'total': 0, 'valid': 0, 'blank': 0, 'comment': 0, 'error': 0,
+            'matched': 0, 'unmatched': 0, 'combined': 0, 'keys': 0, 'matched_keys': 0}
+
+def iter_keyed_lines(file_obj, key_indices, delimiter, counts, comment_lines, collected_keys, error_out):
+    """逐行分类：空行只计数，注释行收集到 comment_lines，键值列不存在的行写入 error_out，
+    其余产出 (行号, 键, 行内容)；同时收集前三个不同的键"""
+    if isinstance(file_obj, ColumnarTable) and delimiter == "\t":
+        yield from iter_keyed_columns(file_obj, key_indices, delimiter, counts, comment_lines,
+                                      collected_keys, error_out)
+        return
     for line in file_obj:
-        total_lines += 1
+        counts['total'] += 1
         stripped = line.strip()
         
         # 处理空行
         if not stripped:
-            blank_lines.append(line.rstrip())
+            counts['blank'] += 1
             continue
             
         # 处理注释行
         if stripped.startswith('#'):
             comment_lines.append(stripped)
+            counts['comment'] += 1
             continue
             
         # 分割行
-        if delimiter == "whitespace":
-            parts = re.split(r'\s+', stripped)
-        else:
-            parts = stripped.split(delimiter)
+        parts = split_fields(stripped, delimiter)
         
         # 检查所有键列是否存在
         if any(idx >= len(parts) for idx in key_indices):
-            error_lines.append(stripped)
+            error_out.write(stripped + '\n')
+            counts['error'] += 1
             continue
             
         # 构建复合键
         key = tuple(parts[idx] for idx in key_indices)
-        ref_dict[key].append(stripped)
-        valid_lines += 1
+        counts['valid'] += 1
         
         # 收集前三个不同的键
-        if key not in seen_keys and len(collected_keys) < 3:
-            seen_keys.add(key)
+        if len(collected_keys) < 3 and key not in collected_keys:
             collected_keys.append(key)
+        
+        yield counts['total'], key, stripped
+
+def iter_keyed_columns(table, key_indices, delimiter, counts, comment_lines, collected_keys, error_out):
+    """列式表的 iter_keyed_lines：键值直接取自键值列，不再拆分行文本；表头等少数行仍按文本规则处理"""
+    for line, key in table.keyed_lines(key_indices):
+        if key is None:
+            yield from iter_keyed_lines((line,), key_indices, delimiter, counts, comment_lines,
+                                        collected_keys, error_out)
+            continue
+        counts['total'] += 1
+        counts['valid'] += 1
+        if len(collected_keys) < 3 and key not in collected_keys:
+            collected_keys.append(key)
+        yield counts['total'], key, line
 
-    return ref_dict, blank_lines, comment_lines, error_lines, unmatched_lines, total_lines, valid_lines, collected_keys
+def process_reference_file(file_obj, key_indices, delimiter, error_out):
+    """处理参考文件，返回 (键值索引, 注释行, 计数, 前三个不同的键)（支持多列键值）
 
-def process_query_file(file_obj, key_indices, delimiter, ref_dict):
-    """处理查询文件，返回组合行和错误行（支持多列键值）"""
-    combine_lines = []
-    blank_lines = []
+    键值列不存在的行直接写入 error_out；内存中只保存键值索引与注释行。
+    """
+    ref_dict = defaultdict(list)
     comment_lines = []
-    unmatched_lines = []
-    error_lines = []
-    total_lines = 0
-    valid_lines = 0
-    matched_lines = 0
+    counts = new_counts()
+    collected_keys = []
+    
+    for _, key, stripped in iter_keyed_lines(file_obj, key_indices, delimiter, counts, comment_lines,
+                                             collected_keys, error_out):
+        ref_dict[key].append(stripped)
+    
+    counts['keys'] = len(ref_dict)
+    return ref_dict, comment_lines, counts, collected_keys
+
+def process_query_file(file_obj, key_indices, delimiter, ref_dict, combine_out, unmatched_out, error_out,
+                       presence=None, resolve=None):
+    """处理查询文件，返回 (注释行, 计数, 前三个不同的键, 匹配到的参考文件键)（支持多列键值）
+
+    组合行、未匹配行、错误行产生后立即写入对应文件，不在内存中累积；presence 为多查询模式下宽表的一列；
+    resolve 为重复键值的处理方式（见 duplicate_resolver），参考行多于一行时才调用。
+    """
+    comment_lines = []
+    counts = new_counts()
     matched_ref_keys = set()  # 记录匹配到的参考文件键
-    collected_keys = []  # 收集前三个不同的键
-    seen_keys = set()
+    collected_keys = []
+    joiner = " " if delimiter == "whitespace" else delimiter
     
-    for line in file_obj:
-        total_lines += 1
-        stripped = line.strip()
-        
-        # 处理空行
-        if not stripped:
-            blank_lines.append(line.rstrip())
-            continue
-            
-        # 处理注释行
-        if stripped.startswith('#'):
-            comment_lines.append(stripped)
-            continue
-            
-        # 分割行
-        if delimiter == "whitespace":
-            parts = re.split(r'\s+', stripped)
-        else:
-            parts = stripped.split(delimiter)
-        
-        # 检查所有键列是否存在
-        if any(idx >= len(parts) for idx in key_indices):
-            error_lines.append(stripped)
-            continue
-            
-        # 构建复合键
-        key = tuple(parts[idx] for idx in key_indices)
-        valid_lines += 1
-        
-        # 收集前三个不同的键
-        if key not in seen_keys and len(collected_keys) < 3:
-            seen_keys.add(key)
-            collected_keys.append(key)
-        
-        if key in ref_dict:
-            matched_lines += 1
+    for _, key, stripped in iter_keyed_lines(file_obj, key_indices, delimiter, counts, comment_lines,
+                                             collected_keys, error_out):
+        ref_lines = ref_dict.get(key)
+        if ref_lines:
+            counts['matched'] += 1
             # 记录匹配到的参考文件键
             matched_ref_keys.add(key)
+            if presence is not None:
+                presence.add(key, stripped)
+            if resolve is not None and len(ref_lines) > 1:
+                ref_lines = resolve(ref_lines)
             # 匹配成功：先输出参考文件内容，再输出查询文件内容
-            for ref_line in ref_dict[key]:
-                if delimiter == "whitespace":
-                    combine_lines.append(f"{ref_line} {stripped}")
-                else:
-                    combine_lines.append(f"{ref_line}{delimiter}{stripped}")
+            for ref_line in ref_lines:
+                combine_out.write(f"{ref_line}{joiner}{stripped}\n")
+            counts['combined'] += len(ref_lines)
         else:
-            unmatched_lines.append(stripped)
+            unmatched_out.write(stripped + '\n')
+            counts['unmatched'] += 1
     
-    return combine_lines, blank_lines, comment_lines, unmatched_lines, error_lines, total_lines, valid_lines, matched_lines, collected_keys, matched_ref_keys
+    return comment_lines, counts, collected_keys, matched_ref_keys
+
+DUPLICATE_POLICIES = ('all', 'first', 'best', 'aggregate')
+
+def duplicate_resolver(args):
+    """--on-duplicate：同一键值对应多行参考行时，选出与查询行组合的参考行；all（全部组合）返回 None
 
-def write_output_files(prefix, combine_lines, rf_comment_lines, rf_unmatched_lines, rf_error_lines, qf_comment_lines, qf_unmatched_lines, qf_error_lines):
-    """写入输出文件"""
-    # 组合结果文件
-    with open(f"{prefix}.combine.file.tsv", 'w') as file:
-        for line in combine_lines:
+    first 取第一行；best 按 --score-columns 各列的数值依次比较取最大的一行（非数值视为最小，并列取靠前的行）；
+    aggregate 合并为一行，每列取各行中不同的值按出现顺序以逗号连接（分隔符为逗号时改用分号）。
+    """
+    delimiter = args.separator
+    if args.on_duplicate == 'first':
+        return lambda lines: lines[:1]
+    if args.on_duplicate == 'best':
+        score_indices = args.score_columns
+        
+        def score(line):
+            parts = split_fields(line, delimiter)
+            values = []
+            for idx in score_indices:
+                try:
+                    values.append(float(parts[idx]))
+                except (IndexError, ValueError):
+                    values.append(float('-inf'))
+            return values
+        
+        return lambda lines: [max(lines, key=score)]
+    if args.on_duplicate == 'aggregate':
+        joiner = " " if delimiter == "whitespace" else delimiter
+        value_joiner = ";" if delimiter == "," else ","
+        
+        def aggregate(lines):
+            rows = [split_fields(line, delimiter) for line in lines]
+            merged = []
+            for i in range(max(map(len, rows))):
+                values = []
+                for row in rows:
+                    value = row[i] if i < len(row) else ""
+                    if value not in values:
+                        values.append(value)
+                merged.append(value_joiner.join(values))
+            return [joiner.join(merged)]
+        
+        return aggregate
+    return None
+
+def write_unmatched_file(path, comment_lines, line_source):
+    """写出未匹配行文件：先写注释行，再写未匹配行（line_source 为行的可迭代对象或已写好的临时文件）"""
+    with open(path, 'w') as file:
+        for line in comment_lines:
             file.write(line + '\n')
+        if hasattr(line_source, 'seek'):
+            line_source.seek(0)
+            shutil.copyfileobj(line_source, file)
+        else:
+            for line in line_source:
+                file.write(line + '\n')
+
+def iter_unmatched_reference_lines(ref_dict, matched_ref_keys):
+    """参考文件中键值未被匹配的行（按键值首次出现的顺序）"""
+    for key in ref_dict:
+        if key not in matched_ref_keys:
+            yield from ref_dict.get(key)
+
+OUTPUT_SUFFIXES = ("combine.file.tsv", "rf.unmatched.line.tsv", "rf.error.line.tsv",
+                   "qf.unmatched.line.tsv", "qf.error.line.tsv")
+
+def check_key_columns(args, ref_counts, qry_counts):
+    """键值列校验（在读取过程中完成，不再预先扫描文件）：文件中没有任何一行包含全部键值列时报错并返回 False
+
+    qry_counts 为 None 时只检查参考文件；报错前删除已写出的部分结果文件。
+    """
+    sep_display = "空格或制表符" if args.separator == "whitespace" else f"'{args.separator}'"
+    if ref_counts['valid'] == 0:
+        messages = [f"错误：参考文件 '{args.ref_file}' 中不存在指定的列 {args.ref_column}",
+                    f"请确认文件格式和列分隔符（当前识别的分隔符为 {sep_display}）"]
+    elif qry_counts is not None and qry_counts['valid'] == 0:
+        messages = [f"错误：查询文件 '{args.query_file}' 中不存在指定的列 {args.query_column}",
+                    f"请确认文件格式和列分隔符（当前识别的分隔符: {sep_display}）"]
+    else:
+        return True
+    for suffix in OUTPUT_SUFFIXES:
+        if os.path.exists(f"{args.prefix}.{suffix}"):
+            os.remove(f"{args.prefix}.{suffix}")
+    for message in messages:
+        print(message, file=sys.stderr)
+    return False
+
+# ---- 参考文件键值索引（--ref-index） ----
+# 索引文件：8 字节标识 + 8 字节元数据长度 + JSON 元数据 + 按 8 字节对齐的数据段。
+# 元数据记录参考文件的 路径/大小/mtime/内容哈希、键值列与分隔符，以及计数、注释行与键值示例；
+# 数据段为：键值（按首次出现的顺序，\n 分隔，多列键内部以 \0 分隔）、每个键的行区间、
+# 每行在参考文件中的字节偏移与长度（去除首尾空白后的内容）、参考错误行原文。
+INDEX_MAGIC = b"MRGKIDX\n"
+INDEX_VERSION = 1
+INDEX_SECTIONS = ('keys', 'line_start', 'line_offset', 'line_length', 'errors')
+
+# 文件内容哈希：BLAKE2b，20 字节摘要，按 1 MiB 分块读取。键值索引、gff.stat.py 的解析缓存索引
+# 与 intron_pipeline.py 的阶段记录都保存这种哈希；gff.stat.py 中的同名常量须与此保持一致，
+# intron_pipeline.py 直接使用本模块的 file_content_hash。
+HASH_DIGEST_SIZE = 20
+HASH_CHUNK_SIZE = 1 << 20
+
+def file_content_hash(path):
+    h = hashlib.blake2b(digest_size=HASH_DIGEST_SIZE)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _read_index_meta(index_path):
+    """读取索引的元数据，返回 (元数据, 数据段起始位置)；文件不存在或格式不符时返回 (None, 0)"""
+    try:
+        with open(index_path, 'rb') as f:
+            header = f.read(16)
+            if len(header) < 16 or header[:8] != INDEX_MAGIC:
+                return None, 0
+            meta_len = struct.unpack('<Q', header[8:])[0]
+            meta = json.loads(f.read(meta_len))
+    except (OSError, ValueError):
+        return None, 0
+    return meta, (16 + meta_len + 7) // 8 * 8
+
+def _write_index_header(out, meta):
+    """写出标识、元数据长度与 JSON 元数据，并补齐到 8 字节对齐的数据段起始位置"""
+    meta_bytes = json.dumps(meta).encode()
+    out.write(INDEX_MAGIC + struct.pack('<Q', len(meta_bytes)) + meta_bytes)
+    out.write(b"\0" * (-out.tell() % 8))
+
+def refresh_index_mtime(index_path, meta, data_start, mtime_ns):
+    """参考文件内容未变、只有 mtime 改变（touch、复制、checkout）时，把新的 mtime 写回索引元数据，
+    之后的运行不再重新计算哈希；数据段原样复制（先写临时文件再改名）"""
+    meta = dict(meta, mtime_ns=mtime_ns)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(index_path, 'rb') as fin, open(tmp_path, 'wb') as out:
+        _write_index_header(out, meta)
+        fin.seek(data_start)
+        shutil.copyfileobj(fin, out)
+    os.replace(tmp_path, index_path)
+
+def index_stale_reason(meta, ref_path, key_indices, delimiter):
+    """索引过期的原因；仍可使用时返回 None（大小与 mtime 未变时不重新计算哈希）"""
+    if meta is None:
+        return "索引不存在或无法读取"
+    if meta.get('version') != INDEX_VERSION:
+        return "索引版本不同"
+    if meta['key_indices'] != key_indices or meta['separator'] != delimiter:
+        return "键值列或分隔符不同"
+    st = os.stat(ref_path)
+    if meta['size'] == st.st_size and meta['mtime_ns'] == st.st_mtime_ns:
+        return None
+    if meta['size'] != st.st_size or file_content_hash(ref_path) != meta['hash']:
+        return "参考文件内容已改变"
+    return None
+
+def scan_reference(ref_path, key_indices, delimiter):
+    """以二进制方式顺序读取一遍参考文件，只记录每行的字节偏移与长度，不保存行内容
+
+    返回字典：keys（键值 -> 序号，按首次出现的顺序，键值各列经 sys.intern 驻留）、
+    line_start/line_offset/line_length（按键分组的行区间与每行的偏移、长度）、
+    comment_lines、counts、collected_keys、errors（参考错误行原文）、hash（文件内容哈希）。
+    """
+    hasher = hashlib.blake2b(digest_size=HASH_DIGEST_SIZE)
+    current = [0, b'']  # 当前行的 (字节偏移, 原始内容)
     
-    # 参考文件未匹配行文件
-    with open(f"{prefix}.rf.unmatched.line.tsv", 'w') as file:
-        for line in rf_comment_lines:
-            file.write(line + '\n')
-        for line in rf_unmatched_lines:
-            file.write(line + '\n')
+    def decoded_lines(f):
+        pos = 0
+        for raw in f:
+            hasher.update(raw)
+            current[0], current[1] = pos, raw
+            pos += len(raw)
+            yield raw.decode()
     
-    # 参考文件错误行文件
-    with open(f"{prefix}.rf.error.line.tsv", 'w') as file:
-        for line in rf_error_lines:
-            file.write(line + '\n')
+    keys = {}
+    key_ids = array('Q')
+    offsets = array('Q')
+    lengths = array('Q')
+    comment_lines = []
+    counts = new_counts()
+    collected_keys = []
+    errors = io.StringIO()
+    with open(ref_path, 'rb') as f:
+        for _, key, stripped in iter_keyed_lines(decoded_lines(f), key_indices, delimiter, counts,
+                                                 comment_lines, collected_keys, errors):
+            key_id = keys.get(key)
+            if key_id is None:
+                key_id = keys[tuple(map(sys.intern, key))] = len(keys)
+            pos, raw = current
+            data = stripped.encode()
+            key_ids.append(key_id)
+            offsets.append(pos + raw.find(data))
+            lengths.append(len(data))
+    counts['keys'] = len(keys)
     
-    # 查询文件未匹配行文件
-    with open(f"{prefix}.qf.unmatched.line.tsv", 'w') as file:
-        for line in qf_comment_lines:
-            file.write(line + '\n')
-        for line in qf_unmatched_lines:
-            file.write(line + '\n')
+    # 计数排序：把行按键分组（组内保持文件顺序）
+    line_start = array('Q', bytes(8 * (len(keys) + 1)))
+    for key_id in key_ids:
+        line_start[key_id + 1] += 1
+    for i in range(len(keys)):
+        line_start[i + 1] += line_start[i]
+    fill = line_start[:-1]
+    line_offset = array('Q', bytes(8 * len(key_ids)))
+    line_length = array('Q', bytes(8 * len(key_ids)))
+    for j, key_id in enumerate(key_ids):
+        line_offset[fill[key_id]] = offsets[j]
+        line_length[fill[key_id]] = lengths[j]
+        fill[key_id] += 1
+    return {'keys': keys, 'line_start': line_start, 'line_offset': line_offset, 'line_length': line_length,
+            'comment_lines': comment_lines, 'counts': counts, 'collected_keys': collected_keys,
+            'errors': errors.getvalue(), 'hash': hasher.hexdigest()}
+
+class OffsetReference:
+    """紧凑的参考键值索引：键值 -> 参考文件中各行的 (偏移, 长度)，行内容在需要时才从内存映射的参考文件中切出
+
+    提供 hash_join 用到的字典接口（get/items/迭代键值/len）；get 每次返回新解码的行列表。
+    """
     
-    # 查询文件错误行文件
-    with open(f"{prefix}.qf.error.line.tsv", 'w') as file:
-        for line in qf_error_lines:
-            file.write(line + '\n')
+    def __init__(self, ref_path, keys, line_start, line_offset, line_length):
+        self.keys = keys
+        self.line_start = line_start
+        self.line_offset = line_offset
+        self.line_length = line_length
+        self._map = None
+        if line_offset:
+            with open(ref_path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    def _lines(self, key_id):
+        ref_map, offsets, lengths = self._map, self.line_offset, self.line_length
+        return [ref_map[offsets[j]:offsets[j] + lengths[j]].decode()
+                for j in range(self.line_start[key_id], self.line_start[key_id + 1])]
+    
+    def get(self, key, default=None):
+        key_id = self.keys.get(key)
+        return default if key_id is None else self._lines(key_id)
+    
+    def line_count(self, key):
+        """键值对应的参考行数（由行区间得到，不切出行内容）"""
+        key_id = self.keys[key]
+        return self.line_start[key_id + 1] - self.line_start[key_id]
+    
+    def items(self):
+        for key, key_id in self.keys.items():
+            yield key, self._lines(key_id)
+    
+    def __iter__(self):
+        return iter(self.keys)
+    
+    def __len__(self):
+        return len(self.keys)
 
-def generate_statistics(args, ref_stats, qry_stats):
-    """生成统计信息并输出到屏幕和日志"""
-    # 解包统计信息
-    ref_dict, ref_blanks, ref_comments, ref_errors, ref_unmatched, ref_total, ref_valid, ref_keys = ref_stats
-    combine_lines, qry_blanks, qry_comments, qry_unmatched, qry_errors, qry_total, qry_valid, qry_matched, qry_keys, matched_ref_keys = qry_stats
+def build_reference_index(ref_path, index_path, key_indices, delimiter):
+    """扫描参考文件并写出键值索引（先写临时文件再改名）"""
+    st = os.stat(ref_path)
+    scan = scan_reference(ref_path, key_indices, delimiter)
+    sections = {
+        'keys': "\n".join("\0".join(key) for key in scan['keys']).encode(),
+        'line_start': scan['line_start'].tobytes(),
+        'line_offset': scan['line_offset'].tobytes(),
+        'line_length': scan['line_length'].tobytes(),
+        'errors': scan['errors'].encode(),
+    }
+    layout = {}
+    pos = 0
+    for name in INDEX_SECTIONS:
+        layout[name] = [pos, len(sections[name])]
+        pos += (len(sections[name]) + 7) // 8 * 8
+    meta = {'version': INDEX_VERSION, 'source': os.path.realpath(ref_path), 'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns, 'hash': scan['hash'], 'key_indices': key_indices,
+            'separator': delimiter, 'counts': scan['counts'], 'collected_keys': scan['collected_keys'],
+            'comment_lines': scan['comment_lines'], 'n_keys': len(scan['keys']), 'sections': layout}
     
-    # 计算参考文件匹配情况
-    ref_unique_keys = set(ref_dict.keys())
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as out:
+        _write_index_header(out, meta)
+        for name in INDEX_SECTIONS:
+            out.write(sections[name] + b"\0" * (-len(sections[name]) % 8))
+    os.replace(tmp_path, index_path)
+
+def load_indexed_reference(args, ref_key_indices):
+    """用键值索引代替逐行拆分参考文件：索引过期（参考文件或键值列改变）时自动重建
+
+    返回值与 process_reference_file 相同（--compact 时键值索引为 OffsetReference，否则参考行
+    按偏移从内存映射的参考文件中切出后放入字典）；参考错误行直接由索引写出到 {prefix}.rf.error.line.tsv。
+    """
+    index_path = args.ref_index
+    meta, data_start = _read_index_meta(index_path)
+    reason = index_stale_reason(meta, args.ref_file, ref_key_indices, args.separator)
+    if reason is not None:
+        build_reference_index(args.ref_file, index_path, ref_key_indices, args.separator)
+        meta, data_start = _read_index_meta(index_path)
+        print(f"[index] {reason}，已重建 {index_path}", file=sys.stderr)
+    else:
+        mtime_ns = os.stat(args.ref_file).st_mtime_ns
+        if meta['mtime_ns'] != mtime_ns:
+            # index_stale_reason 已确认内容哈希一致
+            refresh_index_mtime(index_path, meta, data_start, mtime_ns)
+            meta, data_start = _read_index_meta(index_path)
+        print(f"[index] 使用 {index_path}", file=sys.stderr)
+    
+    with open(index_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as index_map:
+        def section(name):
+            offset, length = meta['sections'][name]
+            return index_map[data_start + offset:data_start + offset + length]
+        
+        with open(f"{args.prefix}.rf.error.line.tsv", 'wb') as rf_error_out:
+            rf_error_out.write(section('errors'))
+        key_text = section('keys').decode()
+        keys = [tuple(map(sys.intern, key.split("\0"))) for key in key_text.split("\n")] if meta['n_keys'] else []
+        reference = OffsetReference(args.ref_file, {key: i for i, key in enumerate(keys)},
+                                    array('Q', section('line_start')), array('Q', section('line_offset')),
+                                    array('Q', section('line_length')))
+    
+    ref_dict = reference if args.compact else dict(reference.items())
+    collected_keys = [tuple(key) for key in meta['collected_keys']]
+    return ref_dict, meta['comment_lines'], meta['counts'], collected_keys
+
+def load_compact_reference(args, ref_key_indices):
+    """--compact（不使用索引文件）：扫描参考文件得到 OffsetReference，返回值与 process_reference_file 相同"""
+    scan = scan_reference(args.ref_file, ref_key_indices, args.separator)
+    with open(f"{args.prefix}.rf.error.line.tsv", 'w') as rf_error_out:
+        rf_error_out.write(scan['errors'])
+    reference = OffsetReference(args.ref_file, scan['keys'], scan['line_start'],
+                                scan['line_offset'], scan['line_length'])
+    return reference, scan['comment_lines'], scan['counts'], scan['collected_keys']
+
+def load_reference(args, ref_file, ref_key_indices):
+    """读取参考文件建立内存键值索引（错误行边读边写出），返回 process_reference_file 的结果
+
+    指定 --ref-index 或 --compact 时改由参考文件路径载入（见 load_indexed_reference、load_compact_reference），
+    ref_file 不再读取。
+    """
+    if args.ref_index:
+        return load_indexed_reference(args, ref_key_indices)
+    if args.compact:
+        return load_compact_reference(args, ref_key_indices)
+    with open(f"{args.prefix}.rf.error.line.tsv", 'w') as rf_error_out:
+        return process_reference_file(ref_file, ref_key_indices, args.separator, rf_error_out)
+
+def join_query(args, reference, qry_file, qry_key_indices, presence=None):
+    """把一个查询文件与已建立的参考索引连接并写出结果文件；返回 generate_statistics 所需的统计
+
+    参考索引只读不改，可被多个查询复用；查询文件中不存在键值列时返回 None。
+    """
+    ref_dict, ref_comments, ref_counts, ref_keys = reference
+    ref_counts = dict(ref_counts)
+    
+    # 处理查询文件：组合行与错误行直接写入结果文件；未匹配行先写入临时文件，最后接在注释行之后
+    spool_dir = os.path.dirname(os.path.abspath(args.prefix))
+    with open(f"{args.prefix}.combine.file.tsv", 'w') as combine_out, \
+            open(f"{args.prefix}.qf.error.line.tsv", 'w') as qf_error_out, \
+            tempfile.TemporaryFile('w+', dir=spool_dir) as qf_unmatched_spool:
+        qry_comments, qry_counts, qry_keys, matched_ref_keys = process_query_file(
+            qry_file, qry_key_indices, args.separator, ref_dict,
+            combine_out, qf_unmatched_spool, qf_error_out, presence, duplicate_resolver(args))
+        write_unmatched_file(f"{args.prefix}.qf.unmatched.line.tsv", qry_comments, qf_unmatched_spool)
+    if not check_key_columns(args, ref_counts, qry_counts):
+        return None
+    write_reference_unmatched(args, ref_dict, ref_comments, ref_counts, matched_ref_keys)
+    return ref_counts, ref_keys, qry_counts, qry_keys
+
+def write_reference_unmatched(args, ref_dict, ref_comments, ref_counts, matched_ref_keys):
+    """参考文件中未匹配的行：查询文件处理完才能确定；同时补全参考文件的匹配计数"""
+    ref_counts['matched_keys'] = len(matched_ref_keys)
+    if isinstance(ref_dict, OffsetReference):
+        matched_lines = sum(map(ref_dict.line_count, matched_ref_keys))
+    else:
+        matched_lines = sum(len(ref_dict[key]) for key in matched_ref_keys)
+    ref_counts['unmatched'] = ref_counts['valid'] - matched_lines
+    write_unmatched_file(f"{args.prefix}.rf.unmatched.line.tsv", ref_comments,
+                         iter_unmatched_reference_lines(ref_dict, matched_ref_keys))
+
+def hash_join(args, ref_file, qry_file, ref_key_indices, qry_key_indices):
+    """哈希连接：参考文件整体建立内存索引，查询文件逐行查找；返回 generate_statistics 所需的统计"""
+    reference = load_reference(args, ref_file, ref_key_indices)
+    if not check_key_columns(args, reference[2], qry_counts=None):
+        sys.exit(1)
+    if args.jobs > 1:
+        stats = parallel_join_query(args, reference, qry_key_indices)
+    else:
+        stats = join_query(args, reference, qry_file, qry_key_indices)
+    if stats is None:
+        sys.exit(1)
+    return stats
+
+# ---- 子进程并行（--jobs） ----
+
+# fork 出的子进程通过写时复制直接使用父进程已建立的参考索引，不做序列化；只在 fork_map 执行期间有效
+_shared_reference = None
+
+def fork_map(func, tasks, jobs, shared):
+    """在 fork 出的子进程中并行执行 func，结果按 tasks 的顺序返回；平台不支持 fork 时依次执行
+
+    shared 在执行期间放在 _shared_reference 中供 func 读取，结束后释放（以模块方式多次调用 main 时不会残留）。
+    """
+    global _shared_reference
+    _shared_reference = shared
+    try:
+        jobs = min(jobs, len(tasks))
+        if jobs > 1 and 'fork' not in get_all_start_methods():
+            print("警告：当前平台不支持 fork，改为单进程处理", file=sys.stderr)
+            jobs = 1
+        if jobs <= 1:
+            return [func(task) for task in tasks]
+        # 参考索引移入永久代，避免子进程中的垃圾回收改写对象头而触发页面复制
+        gc.freeze()
+        try:
+            with get_context('fork').Pool(jobs) as pool:
+                return pool.map(func, tasks, chunksize=1)
+        finally:
+            gc.unfreeze()
+    finally:
+        _shared_reference = None
+
+def line_aligned_bounds(path, n_chunks):
+    """把文件按字节大致均分为 n_chunks 块，每个分界点移到下一行行首；返回分界点列表（含 0 与文件大小）"""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, n_chunks):
+            pos = size * i // n_chunks
+            if pos <= bounds[-1]:
+                continue
+            f.seek(pos)
+            f.readline()
+            if f.tell() >= size:
+                break
+            bounds.append(f.tell())
+    bounds.append(size)
+    return bounds
+
+def iter_byte_range(f, start, end):
+    """逐行读取二进制文件 [start, end) 区间内的行（区间两端均为行首）"""
+    f.seek(start)
+    pos = start
+    for raw in f:
+        if pos >= end:
+            break
+        pos += len(raw)
+        yield raw.decode()
+
+def run_query_chunk(task):
+    """连接查询文件的一个字节区间（可在子进程中运行）：结果写入该块的临时文件，返回 process_query_file 的结果"""
+    args, qry_key_indices, start, end, chunk_prefix = task
+    ref_dict = _shared_reference['reference'][0]
+    with open(args.query_file, 'rb') as f, \
+            open(f"{chunk_prefix}.combine", 'w') as combine_out, \
+            open(f"{chunk_prefix}.unmatched", 'w') as unmatched_out, \
+            open(f"{chunk_prefix}.error", 'w') as error_out:
+        return process_query_file(iter_byte_range(f, start, end), qry_key_indices, args.separator, ref_dict,
+                                  combine_out, unmatched_out, error_out, resolve=duplicate_resolver(args))
+
+def concat_files(out, paths):
+    for path in paths:
+        with open(path, 'r') as f:
+            shutil.copyfileobj(f, out)
+
+def parallel_join_query(args, reference, qry_key_indices):
+    """单个查询文件的并行连接：查询文件按行边界切成字节区间，由 --jobs 个子进程与共享的参考索引连接，
+    各块的结果按输入顺序拼接，与单进程连接的结果完全相同；返回值同 join_query
+    """
+    ref_dict, ref_comments, ref_counts, ref_keys = reference
+    ref_counts = dict(ref_counts)
+    
+    bounds = line_aligned_bounds(args.query_file, args.jobs * 4)
+    spool_dir = os.path.dirname(os.path.abspath(args.prefix))
+    with tempfile.TemporaryDirectory(prefix='merge_chunks_', dir=spool_dir) as chunk_dir:
+        chunk_prefixes = [os.path.join(chunk_dir, str(i)) for i in range(len(bounds) - 1)]
+        tasks = [(args, qry_key_indices, start, end, chunk_prefix)
+                 for start, end, chunk_prefix in zip(bounds, bounds[1:], chunk_prefixes)]
+        results = fork_map(run_query_chunk, tasks, args.jobs, {'reference': reference})
+        
+        # 合并各块的注释行、计数、键值示例与匹配到的参考键
+        qry_comments, qry_counts, qry_keys, matched_ref_keys = [], new_counts(), [], set()
+        for comment_lines, counts, collected_keys, matched in results:
+            qry_comments.extend(comment_lines)
+            for name, value in counts.items():
+                qry_counts[name] += value
+            for key in collected_keys:
+                if len(qry_keys) < 3 and key not in qry_keys:
+                    qry_keys.append(key)
+            matched_ref_keys.update(matched)
+        
+        with open(f"{args.prefix}.combine.file.tsv", 'w') as combine_out:
+            concat_files(combine_out, [f"{chunk_prefix}.combine" for chunk_prefix in chunk_prefixes])
+        with open(f"{args.prefix}.qf.error.line.tsv", 'w') as qf_error_out:
+            concat_files(qf_error_out, [f"{chunk_prefix}.error" for chunk_prefix in chunk_prefixes])
+        with open(f"{args.prefix}.qf.unmatched.line.tsv", 'w') as qf_unmatched_out:
+            for line in qry_comments:
+                qf_unmatched_out.write(line + '\n')
+            concat_files(qf_unmatched_out, [f"{chunk_prefix}.unmatched" for chunk_prefix in chunk_prefixes])
+    if not check_key_columns(args, ref_counts, qry_counts):
+        return None
+    write_reference_unmatched(args, ref_dict, ref_comments, ref_counts, matched_ref_keys)
+    return ref_counts, ref_keys, qry_counts, qry_keys
+
+# ---- 多查询模式（-qf 给出多个文件） ----
+
+class QueryPresence:
+    """宽表中一个查询文件对应的一列：参考文件每个键值匹配到的查询行数，以及首个匹配行的长度列"""
+    
+    def __init__(self, key_index, delimiter, length_index=None):
+        self.key_index = key_index
+        self.delimiter = delimiter
+        self.length_index = length_index
+        self.counts = [0] * len(key_index)
+        self.lengths = None if length_index is None else [None] * len(key_index)
+    
+    def add(self, key, stripped):
+        i = self.key_index[key]
+        if self.counts[i] == 0 and self.lengths is not None:
+            parts = split_fields(stripped, self.delimiter)
+            if self.length_index < len(parts):
+                self.lengths[i] = parts[self.length_index]
+        self.counts[i] += 1
+
+def default_query_label(path):
+    """由查询文件名得到默认标签：去掉目录、压缩后缀与最后一个扩展名（标准输入为 stdin）"""
+    if path == '-':
+        return "stdin"
+    name = os.path.basename(path)
+    for suffix in ('.gz', '.zst'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return os.path.splitext(name)[0] or name
+
+def query_args(args, query_file, prefix):
+    """单个查询文件对应的参数副本（统计与结果文件使用该查询自己的前缀）"""
+    qargs = argparse.Namespace(**vars(args))
+    qargs.query_file = query_file
+    qargs.prefix = prefix
+    return qargs
+
+def run_query(qargs):
+    """连接一个查询文件（可在子进程中运行），返回 (统计, 宽表列的计数, 宽表列的长度)；失败时返回 None"""
+    shared = _shared_reference
+    presence = QueryPresence(shared['key_index'], qargs.separator, shared['length_index'])
+    try:
+        with open_input_file(qargs.query_file) as qry_file:
+            stats = join_query(qargs, shared['reference'], qry_file, shared['qry_key_indices'], presence)
+    except (OSError, ImportError) as e:
+        print(f"错误：无法打开输入文件：{e}", file=sys.stderr)
+        return None
+    if stats is None:
+        return None
+    return stats, presence.counts, presence.lengths
+
+def write_matrix(path, ref_key_indices, keys, labels, columns, missing):
+    """写出宽表：每行一个参考文件键值（按首次出现的顺序），每个查询文件一列"""
+    with open(path, 'w') as out:
+        out.write("\t".join([f"ref_col{idx + 1}" for idx in ref_key_indices] + labels) + "\n")
+        for i, key in enumerate(keys):
+            values = [missing if column[i] is None else str(column[i]) for column in columns]
+            out.write("\t".join(list(key) + values) + "\n")
+
+def multi_query_join(args, ref_key_indices, qry_key_indices):
+    """一个参考文件对多个查询文件：参考索引只建立一次，各查询依次（或 --jobs 个子进程并行）与之连接
+
+    每个查询的结果文件与日志使用前缀 {prefix}.{标签}；另外写出所有查询的存在/缺失宽表
+    {prefix}.presence.matrix.tsv（值为匹配到的查询行数，0 表示缺失），指定 --length-column 时
+    再写出长度宽表 {prefix}.length.matrix.tsv（缺失为 NA）。返回是否所有查询都成功。
+    """
+    prefixes = [f"{args.prefix}.{label}" for label in args.query_labels]
+    tasks = [query_args(args, query_file, prefix) for query_file, prefix in zip(args.query_files, prefixes)]
+    
+    # 参考文件只读一次；参考错误行写入第一个查询的前缀下，再复制给其余查询
+    try:
+        ref_file = open_input_file(args.ref_file)
+    except (OSError, ImportError) as e:
+        print(f"错误：无法打开输入文件：{e}", file=sys.stderr)
+        sys.exit(1)
+    with ref_file:
+        reference = load_reference(tasks[0], ref_file, ref_key_indices)
+    if not check_key_columns(tasks[0], reference[2], qry_counts=None):
+        sys.exit(1)
+    for prefix in prefixes[1:]:
+        shutil.copyfile(f"{prefixes[0]}.rf.error.line.tsv", f"{prefix}.rf.error.line.tsv")
+    
+    ref_dict = reference[0]
+    shared = {
+        'reference': reference,
+        'key_index': {key: i for i, key in enumerate(ref_dict)},
+        'qry_key_indices': qry_key_indices,
+        'length_index': None if args.length_column is None else args.length_column - 1,
+    }
+    results = fork_map(run_query, tasks, args.jobs, shared)
+    
+    # 统计按查询文件的给定顺序输出
+    ok = True
+    labels, counts_columns, length_columns = [], [], []
+    for label, qargs, result in zip(args.query_labels, tasks, results):
+        if result is None:
+            ok = False
+            continue
+        stats, counts, lengths = result
+        ok = generate_statistics(qargs, *stats) and ok
+        labels.append(label)
+        counts_columns.append(counts)
+        length_columns.append(lengths)
     
-    ref_matched_keys = len(matched_ref_keys)
-    ref_matched_lines = len(combine_lines)
-    ref_unmatched_lines = len(ref_dict) - ref_matched_keys
+    write_matrix(f"{args.prefix}.presence.matrix.tsv", ref_key_indices, ref_dict, labels, counts_columns, "0")
+    matrices = [f"{args.prefix}.presence.matrix.tsv"]
+    if args.length_column is not None:
+        write_matrix(f"{args.prefix}.length.matrix.tsv", ref_key_indices, ref_dict, labels, length_columns, "NA")
+        matrices.append(f"{args.prefix}.length.matrix.tsv")
+    print(f"\n宽表（{len(ref_dict)} 个参考键值 x {len(labels)} 个查询文件）: {', '.join(matrices)}")
+    return ok
+
+# ---- 排序归并连接（--engine sortmerge） ----
+# 临时文件中每次 pickle 的记录条数（逐条 pickle 的调用开销远大于数据本身）
+RUN_CHUNK = 4096
+
+def _write_sorted_run(buffer, run_dir):
+    buffer.sort(key=itemgetter(0))
+    fd, path = tempfile.mkstemp(suffix='.run', dir=run_dir)
+    with os.fdopen(fd, 'wb') as f:
+        for lo in range(0, len(buffer), RUN_CHUNK):
+            pickle.dump(buffer[lo:lo + RUN_CHUNK], f, pickle.HIGHEST_PROTOCOL)
+    return path
+
+def _read_sorted_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield from pickle.load(f)
+            except EOFError:
+                return
+
+class SortedSpool:
+    """按 item[0] 排序的外部排序缓冲：每 buffer_size 条排序后写入 run_dir 下的临时文件，sorted() 时多路归并"""
+    
+    def __init__(self, run_dir, buffer_size):
+        self.run_dir = run_dir
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.run_paths = []
+    
+    def add(self, item):
+        self.buffer.append(item)
+        if len(self.buffer) >= self.buffer_size:
+            self.run_paths.append(_write_sorted_run(self.buffer, self.run_dir))
+            self.buffer = []
+    
+    def sorted(self):
+        if not self.run_paths:
+            # 数据量小于缓冲区时无需落盘
+            self.buffer.sort(key=itemgetter(0))
+            return iter(self.buffer)
+        if self.buffer:
+            self.run_paths.append(_write_sorted_run(self.buffer, self.run_dir))
+            self.buffer = []
+        return heapq.merge(*(_read_sorted_run(p) for p in self.run_paths), key=itemgetter(0))
+
+def sort_keyed_lines(file_obj, key_indices, delimiter, error_out, run_dir, buffer_size):
+    """按 (键, 行号) 外部排序一个输入文件，返回 (有序迭代器, 注释行, 计数, 前三个不同的键)"""
+    comment_lines = []
+    counts = new_counts()
+    collected_keys = []
+    spool = SortedSpool(run_dir, buffer_size)
+    for line_no, key, stripped in iter_keyed_lines(file_obj, key_indices, delimiter, counts, comment_lines,
+                                                   collected_keys, error_out):
+        spool.add(((key, line_no), stripped))
+    return spool.sorted(), comment_lines, counts, collected_keys
+
+def iter_key_groups(sorted_items):
+    """把按 (键, 行号) 有序的记录按键分组，产出 (键, [(行号, 行内容), ...])"""
+    for key, group in groupby(sorted_items, key=lambda item: item[0][0]):
+        yield key, [(line_no, line) for (_, line_no), line in group]
+
+def sortmerge_join(args, ref_file, qry_file, ref_key_indices, qry_key_indices):
+    """排序归并连接：两个文件都按键外部排序后归并，内存占用受 --sort-buffer 限制
+
+    结果与 hash_join 完全相同：组合行与查询未匹配行按查询文件行号、参考未匹配行按其键值首次出现的行号
+    再各做一次外部排序，恢复哈希连接的输出顺序。
+    """
+    joiner = " " if args.separator == "whitespace" else args.separator
+    resolve = duplicate_resolver(args)
+    with tempfile.TemporaryDirectory(prefix='merge_sort_', dir=args.tmpdir) as run_dir:
+        with open(f"{args.prefix}.rf.error.line.tsv", 'w') as rf_error_out:
+            ref_sorted, ref_comments, ref_counts, ref_keys = sort_keyed_lines(
+                ref_file, ref_key_indices, args.separator, rf_error_out, run_dir, args.sort_buffer)
+        if not check_key_columns(args, ref_counts, qry_counts=None):
+            sys.exit(1)
+        with open(f"{args.prefix}.qf.error.line.tsv", 'w') as qf_error_out:
+            qry_sorted, qry_comments, qry_counts, qry_keys = sort_keyed_lines(
+                qry_file, qry_key_indices, args.separator, qf_error_out, run_dir, args.sort_buffer)
+        if not check_key_columns(args, ref_counts, qry_counts):
+            sys.exit(1)
+        
+        combined = SortedSpool(run_dir, args.sort_buffer)
+        qry_unmatched = SortedSpool(run_dir, args.sort_buffer)
+        ref_unmatched = SortedSpool(run_dir, args.sort_buffer)
+        ref_groups = iter_key_groups(ref_sorted)
+        qry_groups = iter_key_groups(qry_sorted)
+        ref_group = next(ref_groups, None)
+        qry_group = next(qry_groups, None)
+        while ref_group is not None or qry_group is not None:
+            if qry_group is None or (ref_group is not None and ref_group[0] < qry_group[0]):
+                # 只在参考文件中出现的键；按键值首次出现的行号排序输出
+                ref_counts['keys'] += 1
+                ref_counts['unmatched'] += len(ref_group[1])
+                first_line_no = ref_group[1][0][0]
+                for line_no, line in ref_group[1]:
+                    ref_unmatched.add(((first_line_no, line_no), line))
+                ref_group = next(ref_groups, None)
+            elif ref_group is None or qry_group[0] < ref_group[0]:
+                # 只在查询文件中出现的键
+                qry_counts['unmatched'] += len(qry_group[1])
+                for line_no, line in qry_group[1]:
+                    qry_unmatched.add((line_no, line))
+                qry_group = next(qry_groups, None)
+            else:
+                ref_counts['keys'] += 1
+                ref_counts['matched_keys'] += 1
+                ref_lines = [line for _, line in ref_group[1]]
+                if resolve is not None and len(ref_lines) > 1:
+                    ref_lines = resolve(ref_lines)
+                qry_counts['matched'] += len(qry_group[1])
+                qry_counts['combined'] += len(qry_group[1]) * len(ref_lines)
+                for line_no, line in qry_group[1]:
+                    combined.add((line_no, "".join(f"{ref_line}{joiner}{line}\n" for ref_line in ref_lines)))
+                ref_group = next(ref_groups, None)
+                qry_group = next(qry_groups, None)
+        
+        with open(f"{args.prefix}.combine.file.tsv", 'w') as combine_out:
+            combine_out.writelines(text for _, text in combined.sorted())
+        write_unmatched_file(f"{args.prefix}.qf.unmatched.line.tsv", qry_comments,
+                             (line for _, line in qry_unmatched.sorted()))
+        write_unmatched_file(f"{args.prefix}.rf.unmatched.line.tsv", ref_comments,
+                             (line for _, line in ref_unmatched.sorted()))
+    return ref_counts, ref_keys, qry_counts, qry_keys
+
+# ---- 列式连接（--engine arrow） ----
+# 整个文件读入为一个 Arrow 字符串数组，去除首尾空白、分类、拆分与取键值列都由 pyarrow.compute 整列完成；
+# 参考键值经字典编码得到按首次出现顺序编号的键值序号，查询键值用 index_in 整列查找序号，
+# 组合行由按键值分组的参考行号（计数排序）展开得到，天然按 (查询行号, 参考行号) 有序。
+# 行内容不做类型转换，输出与 hash 引擎逐字节相同。
+
+def read_arrow_lines(file_obj, key_indices, delimiter):
+    """整列读取并分类一个输入文件，返回字典：key（键值，多列键以分隔符连接）、lines（有效行）、
+    errors（错误行）、comment_lines、counts、collected_keys
+
+    列式表（Parquet/Feather）直接读入为 pyarrow.Table，键值取自键值列（见 read_columnar_lines）。
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    
+    if isinstance(file_obj, ColumnarTable):
+        lines, key_columns = read_columnar_lines(file_obj, key_indices, delimiter)
+        if key_columns is not None:
+            counts = new_counts()
+            counts['total'] = counts['valid'] = len(lines)
+            return {'key': _arrow_key(key_columns, delimiter), 'lines': lines, 'errors': lines.slice(0, 0),
+                    'comment_lines': [], 'counts': counts, 'collected_keys': first_distinct_keys(key_columns)}
+        return classify_arrow_lines(lines, key_indices, delimiter)
+    
+    # 与逐行读取一致：文本模式已统一换行符，末尾换行符之后不再算一行
+    text = file_obj.read() if hasattr(file_obj, 'read') else "".join(file_obj)
+    lines = pc.split_pattern(pa.array([text], type=pa.large_string()), "\n").flatten()
+    if not text:
+        lines = lines.slice(0, 0)
+    elif text.endswith("\n"):
+        lines = lines.slice(0, len(lines) - 1)
+    del text
+    return classify_arrow_lines(lines, key_indices, delimiter)
+
+def read_columnar_lines(table_file, key_indices, delimiter):
+    """把列式表整表读入，返回 (行, 键值列)：各列按 ColumnarTable.text_columns 转为文本（首行为表头），
+    以制表符连接为行；制表符分隔且所有行都是普通数据行时键值列直接取自表中的列，否则为 None（按文本规则拆分）
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    table = table_file.read_table()
+    batches = [ColumnarTable.text_columns(batch) for batch in table.to_batches()]
+    columns = [pc.cast(pa.concat_arrays([pa.array([name], pa.string())] + [batch[i] for batch in batches]),
+                       pa.large_string())
+               for i, name in enumerate(table.schema.names)]
+    del table, batches
+    lines = _join_columns(columns)
+    if delimiter != "\t" or max(key_indices) >= len(columns) or not pc.all(_plain_rows(columns)).as_py():
+        return lines, None
+    return lines, [columns[idx] for idx in key_indices]
+
+def _arrow_key(key_columns, delimiter):
+    """键值数组：多列键以分隔符连接"""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    if len(key_columns) == 1:
+        return key_columns[0]
+    joiner = pa.scalar(" " if delimiter == "whitespace" else delimiter, pa.large_string())
+    return pc.binary_join_element_wise(*key_columns, joiner)
+
+def classify_arrow_lines(lines, key_indices, delimiter):
+    """按文本规则分类各行（去除首尾空白、空行、注释行、错误行），拆分到最后一个键值列为止取出键值"""
+    import pyarrow.compute as pc
+    
+    stripped = pc.utf8_trim_whitespace(lines)
+    del lines
+    blank = pc.equal(pc.utf8_length(stripped), 0)
+    comment = pc.starts_with(stripped, "#")
+    counts = new_counts()
+    counts['total'] = len(stripped)
+    counts['blank'] = pc.sum(blank).as_py() or 0
+    counts['comment'] = pc.sum(comment).as_py() or 0
+    comment_lines = stripped.filter(comment).to_pylist()
+    
+    # 只拆到最后一个键值列为止
+    rest = stripped.filter(pc.invert(pc.or_(blank, comment)))
+    max_splits = max(key_indices) + 1
+    if delimiter == "whitespace":
+        parts = pc.split_pattern_regex(rest, r"\s+", max_splits=max_splits)
+    else:
+        parts = pc.split_pattern(rest, delimiter, max_splits=max_splits)
+    has_keys = pc.greater(pc.list_value_length(parts), max(key_indices))
+    errors = rest.filter(pc.invert(has_keys))
+    parts = parts.filter(has_keys)
+    key_columns = [pc.list_element(parts, idx) for idx in key_indices]
+    key = _arrow_key(key_columns, delimiter)
+    counts['error'] = len(errors)
+    counts['valid'] = len(key)
+    return {'key': key, 'lines': rest.filter(has_keys), 'errors': errors, 'comment_lines': comment_lines,
+            'counts': counts, 'collected_keys': first_distinct_keys(key_columns)}
+
+def first_distinct_keys(key_columns, limit=3):
+    """按行顺序取前 limit 个不同的键（只转换开头的少量行）"""
+    keys = []
+    start, step = 0, 64
+    while len(keys) < limit and start < len(key_columns[0]):
+        for key in zip(*(column.slice(start, step).to_pylist() for column in key_columns)):
+            if key not in keys:
+                keys.append(key)
+                if len(keys) == limit:
+                    break
+        start += step
+        step *= 2
+    return keys
+
+def write_arrow_lines(out, array, comment_lines=()):
+    """写出二进制文件：先写注释行，再把字符串数组逐行写出（直接写出 Arrow 的数据缓冲区）"""
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    
+    out.write("".join(line + "\n" for line in comment_lines).encode())
+    if len(array) == 0:
+        return
+    newline = pa.scalar("\n", pa.large_string())
+    array = pc.binary_join_element_wise(array, pa.scalar("", pa.large_string()), newline)
+    for chunk in (array.chunks if isinstance(array, pa.ChunkedArray) else [array]):
+        offsets = np.frombuffer(chunk.buffers()[1], dtype=np.int64)[chunk.offset:chunk.offset + len(chunk) + 1]
+        out.write(memoryview(chunk.buffers()[2])[offsets[0]:offsets[-1]])
+
+def arrow_join(args, ref_file, qry_file, ref_key_indices, qry_key_indices):
+    """列式连接：两个文件整列读入后按键值序号匹配；返回值同 hash_join
+
+    组合行按 (查询行号, 参考行号) 输出，参考未匹配行按 (键值首次出现的顺序, 行号) 输出；
+    --on-duplicate 不为 all 时，重复键值的参考行交给 duplicate_resolver 处理（只涉及重复键值的行）。
+    """
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    
+    ref = read_arrow_lines(ref_file, ref_key_indices, args.separator)
+    with open(f"{args.prefix}.rf.error.line.tsv", 'wb') as rf_error_out:
+        write_arrow_lines(rf_error_out, ref['errors'])
+    ref_counts = ref['counts']
+    if not check_key_columns(args, ref_counts, qry_counts=None):
+        sys.exit(1)
+    qry = read_arrow_lines(qry_file, qry_key_indices, args.separator)
+    with open(f"{args.prefix}.qf.error.line.tsv", 'wb') as qf_error_out:
+        write_arrow_lines(qf_error_out, qry['errors'])
+    qry_counts = qry['counts']
+    
+    # 参考键值序号（按首次出现的顺序），以及按序号分组的参考行号（组内保持文件顺序）
+    encoded = pc.dictionary_encode(ref['key'])
+    ref_key_ids = encoded.indices.to_numpy(zero_copy_only=False).astype(np.int64)
+    n_keys = len(encoded.dictionary)
+    ref_counts['keys'] = n_keys
+    key_sizes = np.bincount(ref_key_ids, minlength=n_keys)
+    key_starts = np.concatenate(([0], np.cumsum(key_sizes)))
+    ref_order = np.argsort(ref_key_ids, kind='stable')
+    
+    # 查询行对应的参考键值序号；键值列数不同时不可能匹配
+    if len(qry_key_indices) == len(ref_key_indices):
+        found = pc.index_in(qry['key'], value_set=encoded.dictionary)
+        matched = pc.is_valid(found).to_numpy(zero_copy_only=False)
+        qry_key_ids = pc.fill_null(found, 0).to_numpy(zero_copy_only=False).astype(np.int64)
+    else:
+        matched = np.zeros(qry_counts['valid'], bool)
+        qry_key_ids = np.zeros(qry_counts['valid'], np.int64)
+    matched_rows = np.flatnonzero(matched)
+    matched_ids = qry_key_ids[matched_rows]
+    key_matched = np.zeros(n_keys, bool)
+    key_matched[matched_ids] = True
+    
+    # 参与组合的参考行：all 为全部行；其余方式每个键值一行，重复键值在 Python 中处理
+    resolve = duplicate_resolver(args)
+    if resolve is None:
+        join_lines, join_starts, join_sizes = ref['lines'].take(pa.array(ref_order)), key_starts, key_sizes
+    else:
+        join_lines = ref['lines'].take(pa.array(ref_order[key_starts[:-1]]))
+        dup_ids = np.flatnonzero((key_sizes > 1) & key_matched)
+        if len(dup_ids):
+            resolved = [resolve(ref['lines'].take(pa.array(ref_order[key_starts[i]:key_starts[i + 1]])).to_pylist())[0]
+                        for i in dup_ids]
+            mask = np.zeros(n_keys, bool)
+            mask[dup_ids] = True
+            join_lines = pc.replace_with_mask(join_lines, pa.array(mask),
+                                              pa.array(resolved, pa.large_string()))
+        join_starts, join_sizes = np.arange(n_keys + 1), np.ones(n_keys, np.int64)
+    
+    # 组合行：每个匹配的查询行重复该键值的参考行数次，参考行按组内顺序展开
+    repeats = join_sizes[matched_ids]
+    total = int(repeats.sum())
+    pair_qry = np.repeat(matched_rows, repeats)
+    pair_ref = np.repeat(join_starts[matched_ids] - (np.cumsum(repeats) - repeats), repeats) + np.arange(total)
+    joiner = pa.scalar(" " if args.separator == "whitespace" else args.separator, pa.large_string())
+    with open(f"{args.prefix}.combine.file.tsv", 'wb') as combine_out:
+        write_arrow_lines(combine_out, pc.binary_join_element_wise(
+            join_lines.take(pa.array(pair_ref)), qry['lines'].take(pa.array(pair_qry)), joiner))
+    
+    qry_counts['matched'] = len(matched_rows)
+    qry_counts['unmatched'] = qry_counts['valid'] - len(matched_rows)
+    qry_counts['combined'] = total
+    with open(f"{args.prefix}.qf.unmatched.line.tsv", 'wb') as qf_unmatched_out:
+        write_arrow_lines(qf_unmatched_out, qry['lines'].filter(pa.array(~matched)), qry['comment_lines'])
+    if not check_key_columns(args, ref_counts, qry_counts):
+        sys.exit(1)
+    
+    # 参考文件中未匹配的行
+    ref_unmatched = ref_order[~key_matched[ref_key_ids[ref_order]]]
+    ref_counts['matched_keys'] = int(key_matched.sum())
+    ref_counts['unmatched'] = len(ref_unmatched)
+    with open(f"{args.prefix}.rf.unmatched.line.tsv", 'wb') as rf_unmatched_out:
+        write_arrow_lines(rf_unmatched_out, ref['lines'].take(pa.array(ref_unmatched)), ref['comment_lines'])
+    return ref_counts, ref['collected_keys'], qry_counts, qry['collected_keys']
+
+def generate_statistics(args, ref_counts, ref_keys, qry_counts, qry_keys):
+    """生成统计信息并输出到屏幕和日志；键值完全不同时报错并返回 False"""
+    # 计算参考文件匹配情况
+    ref_matched_keys = ref_counts['matched_keys']
+    ref_matched_lines = qry_counts['combined']
+    ref_unmatched_lines = ref_counts['keys'] - ref_matched_keys
     
     # 获取分隔符显示名称
     sep_display = "空格或制表符" if args.separator == "whitespace" else f"'{args.separator}'"
@@ -209,32 +1258,32 @@ def generate_statistics(args, ref_stats, qry_stats):
         "=" * 50,
         "文件处理统计信息",
         "=" * 50,
-        f"参考文件: {args.ref_file.name}",
-        f"  总行数: {ref_total}",
-        f"  有效行数: {ref_valid} (去除空行和注释行)",
-        f"  空白行: {len(ref_blanks)} (仅记录，不写入文件)",
-        f"  注释行: {len(ref_comments)} (已写入未匹配文件)",
-        f"  错误行数: {len(ref_errors)} (键值列不存在)",
-        f"  唯一键值数: {len(ref_unique_keys)}",
+        f"参考文件: {args.ref_file}",
+        f"  总行数: {ref_counts['total']}",
+        f"  有效行数: {ref_counts['valid']} (去除空行和注释行)",
+        f"  空白行: {ref_counts['blank']} (仅记录，不写入文件)",
+        f"  注释行: {ref_counts['comment']} (已写入未匹配文件)",
+        f"  错误行数: {ref_counts['error']} (键值列不存在)",
+        f"  唯一键值数: {ref_counts['keys']}",
         f"  匹配键值数: {ref_matched_keys}",
         f"  匹配行数: {ref_matched_lines}",
         f"  未匹配行数: {ref_unmatched_lines}",
         "",
-        f"查询文件: {args.query_file.name}",
-        f"  总行数: {qry_total}",
-        f"  有效行数: {qry_valid} (去除空行和注释行)",
-        f"  空白行: {len(qry_blanks)} (仅记录，不写入文件)",
-        f"  注释行: {len(qry_comments)} (已写入未匹配文件)",
-        f"  错误行数: {len(qry_errors)} (键值列不存在)",
-        f"  匹配行数: {qry_matched}",
-        f"  未匹配行数: {len(qry_unmatched)}",
+        f"查询文件: {args.query_file}",
+        f"  总行数: {qry_counts['total']}",
+        f"  有效行数: {qry_counts['valid']} (去除空行和注释行)",
+        f"  空白行: {qry_counts['blank']} (仅记录，不写入文件)",
+        f"  注释行: {qry_counts['comment']} (已写入未匹配文件)",
+        f"  错误行数: {qry_counts['error']} (键值列不存在)",
+        f"  匹配行数: {qry_counts['matched']}",
+        f"  未匹配行数: {qry_counts['unmatched']}",
         "",
         "输出文件:",
-        f"  匹配结果: {args.prefix}.combine.file.tsv ({len(combine_lines)} 行)",
-        f"  参考文件未匹配行: {args.prefix}.rf.unmatched.line.tsv ({len(ref_comments) + len(ref_unmatched)} 行)",
-        f"  参考文件错误行: {args.prefix}.rf.error.line.tsv ({len(ref_errors)} 行)",
-        f"  查询文件未匹配行: {args.prefix}.qf.unmatched.line.tsv ({len(qry_comments) + len(qry_unmatched)} 行)",
-        f"  查询文件错误行: {args.prefix}.qf.error.line.tsv ({len(qry_errors)} 行)",
+        f"  匹配结果: {args.prefix}.combine.file.tsv ({qry_counts['combined']} 行)",
+        f"  参考文件未匹配行: {args.prefix}.rf.unmatched.line.tsv ({ref_counts['comment'] + ref_counts['unmatched']} 行)",
+        f"  参考文件错误行: {args.prefix}.rf.error.line.tsv ({ref_counts['error']} 行)",
+        f"  查询文件未匹配行: {args.prefix}.qf.unmatched.line.tsv ({qry_counts['comment'] + qry_counts['unmatched']} 行)",
+        f"  查询文件错误行: {args.prefix}.qf.error.line.tsv ({qry_counts['error']} 行)",
         f"  使用的分隔符: {sep_display}",
         f"  键值列: 参考文件={args.ref_column}, 查询文件={args.query_column}",
         f"  合并顺序: 参考文件内容 + 查询文件内容",
@@ -246,7 +1295,7 @@ def generate_statistics(args, ref_stats, qry_stats):
         print(line)
     
     # 检查键值是否完全不同
-    if ref_matched_keys == 0 and len(ref_dict) > 0 and qry_valid > 0:
+    if ref_matched_keys == 0 and ref_counts['keys'] > 0 and qry_counts['valid'] > 0:
         error_msg = "错误：给定键值完全不同，无法做匹配识别，无法完成文件合并"
         print(f"\n{error_msg}", file=sys.stderr)
         print(f"参考文件键值示例: {ref_keys}", file=sys.stderr)
@@ -257,7 +1306,7 @@ def generate_statistics(args, ref_stats, qry_stats):
             log_file.write(f"参考文件键值示例: {ref_keys}\n")
             log_file.write(f"查询文件键值示例: {qry_keys}\n")
         
-        sys.exit(1)
+        return False
     
     print(f"\n相关提示:",
           f"1. {args.prefix}.combine.file.tsv 只包含匹配成功的行",
@@ -273,7 +1322,7 @@ def generate_statistics(args, ref_stats, qry_stats):
         for line in stats:
             log_file.write(line + '\n')
     
-    return stats
+    return True
 
 def runcominbefile(args):
     """主逻辑处理函数"""
@@ -281,77 +1330,127 @@ def runcominbefile(args):
     ref_key_indices = parse_column_spec(args.ref_column)
     qry_key_indices = parse_column_spec(args.query_column)
     
-    # 检查键值列是否超出文件范围
-    if not check_columns_in_file(args.ref_file, ref_key_indices, args.ref_file.name, "参考文件", args.separator):
-        print(f"错误：参考文件 '{args.ref_file.name}' 中不存在指定的列 {args.ref_column}", file=sys.stderr)
-        sep_display = "空格或制表符" if args.separator == "whitespace" else f"'{args.separator}'"
-        print(f"请确认文件格式和列分隔符（当前识别的分隔符为 {sep_display}）", file=sys.stderr)
-        sys.exit(1)
+    if len(args.query_files) > 1:
+        if not multi_query_join(args, ref_key_indices, qry_key_indices):
+            sys.exit(1)
+        return
     
-    if not check_columns_in_file(args.query_file, qry_key_indices, args.query_file.name, "查询文件", args.separator):
-        print(f"错误：查询文件 '{args.query_file.name}' 中不存在指定的列 {args.query_column}", file=sys.stderr)
-        sep_display = "空格或制表符" if args.separator == "whitespace" else f"'{args.separator}'"
-        print(f"请确认文件格式和列分隔符（当前识别的分隔符: {sep_display}）", file=sys.stderr)
+    # 每个输入只顺序读取一次（可为标准输入、命名管道或压缩文件），键值列在读取过程中校验
+    try:
+        ref_file = open_input_file(args.ref_file)
+        qry_file = open_input_file(args.query_file)
+    except (OSError, ImportError) as e:
+        print(f"错误：无法打开输入文件：{e}", file=sys.stderr)
         sys.exit(1)
     
-    # 重置文件指针
-    args.ref_file.seek(0)
-    args.query_file.seek(0)
-    
-    # 处理参考文件
-    ref_stats = process_reference_file(args.ref_file, ref_key_indices, args.separator)
-    ref_dict = ref_stats[0]
-    
-    # 处理查询文件
-    qry_stats = process_query_file(args.query_file, qry_key_indices, args.separator, ref_dict)
-    
-    # 提取参考文件中未匹配的行
-    matched_ref_keys = qry_stats[-1]  # 最后一个元素是匹配的参考文件键
-    ref_unmatched_lines = []
-    
-    for key, lines in ref_dict.items():
-        if key not in matched_ref_keys:
-            ref_unmatched_lines.extend(lines)
-    
-    # 更新参考文件统计中的未匹配行
-    ref_stats = list(ref_stats)
-    ref_stats[4] = ref_unmatched_lines  # 索引4是未匹配行
-    
-    # 写入输出文件
-    write_output_files(
-        args.prefix, 
-        qry_stats[0],  # combine_lines
-        ref_stats[2],  # 参考文件注释行
-        ref_stats[4],  # 参考文件未匹配行
-        ref_stats[3],  # 参考文件错误行
-        qry_stats[2],  # 查询文件注释行
-        qry_stats[3],  # 查询文件未匹配行
-        qry_stats[4]   # 查询文件错误行
-    )
+    with ref_file, qry_file:
+        if args.engine == "sortmerge":
+            stats = sortmerge_join(args, ref_file, qry_file, ref_key_indices, qry_key_indices)
+        elif args.engine == "arrow":
+            stats = arrow_join(args, ref_file, qry_file, ref_key_indices, qry_key_indices)
+        else:
+            stats = hash_join(args, ref_file, qry_file, ref_key_indices, qry_key_indices)
     
     # 生成统计信息
-    generate_statistics(args, tuple(ref_stats), qry_stats)
+    if not generate_statistics(args, *stats):
+        sys.exit(1)
 
-def main():
-    """主函数，解析命令行参数并调用处理函数"""
+def main(argv=None):
+    """主函数，解析命令行参数并调用处理函数（argv 为 None 时使用 sys.argv，供其他脚本以模块方式调用）"""
     parser = argparse.ArgumentParser(
         description='文件键值匹配工具：基于指定列匹配两个文件（支持多列键值）',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter
     )
-    parser.add_argument('-rf', '--ref_file', required=True, type=argparse.FileType('r'),
-                        help='参考文件路径')
+    parser.add_argument('-rf', '--ref_file', required=True,
+                        help='参考文件路径（- 为标准输入；支持命名管道、.gz/.zst 压缩文件，.parquet/.feather 按列式表读取）')
     parser.add_argument('-rc', '--ref_column', type=str, default="1",
                         help='参考文件键列索引（从1开始），支持多列（如：1,3或1-3或1,4-5）')
-    parser.add_argument('-qf', '--query_file', required=True, type=argparse.FileType('r'),
-                        help='查询文件路径')
+    parser.add_argument('-qf', '--query_file', required=True, nargs='+',
+                        help='查询文件路径（同 -rf）；给出多个文件时参考索引只建立一次，'
+                             '每个查询的结果使用前缀 {prefix}.{标签}，并输出所有查询的存在/缺失宽表')
     parser.add_argument('-qc', '--query_column', type=str, default="1",
                         help='查询文件键列索引（从1开始），支持多列（如：1,3或1-3或1,4-5）')
     parser.add_argument('-sp', '--separator', default="\t", 
                         help='列分隔符（默认: 制表符, 或指定特定分隔符如","，或"whitespace"表示空格/制表符）')
     parser.add_argument('-pf', '--prefix', required=True, 
                         help='输出文件前缀')
+    parser.add_argument('--engine', choices=['hash', 'sortmerge', 'arrow'], default='hash',
+                        help='连接方式：hash 将参考文件整体读入内存；sortmerge 将两个文件按键外部排序后归并，适用于超出内存的输入；'
+                             'arrow 将两个文件整列读入，用 pyarrow 完成拆分与连接（需要 pyarrow，结果与 hash 相同，内存占用约为输入文件的数倍）')
+    parser.add_argument('--sort-buffer', type=int, default=1000000,
+                        help='sortmerge 模式下每个排序块的行数（越小内存占用越低，临时文件越多）')
+    parser.add_argument('--tmpdir', help='sortmerge 模式下排序临时文件所在目录（默认系统临时目录）')
+    parser.add_argument('--ref-index', nargs='?', const='',
+                        help='使用参考文件的持久键值索引（默认 {参考文件}.keyidx）：首次运行时建立，之后直接载入；'
+                             '参考文件内容、键值列或分隔符改变时自动重建（仅 hash 模式，参考文件须为未压缩的普通文件）')
+    parser.add_argument('--compact', action='store_true',
+                        help='紧凑模式：参考文件以内存映射方式读取，内存中只保存键值与各行的偏移、长度，'
+                             '行内容在写出匹配结果时才切出（仅 hash 模式，参考文件须为未压缩的普通文件）')
+    parser.add_argument('--on-duplicate', choices=DUPLICATE_POLICIES, default='all',
+                        help='同一键值有多行参考行时的处理方式：all 与每行查询行全部组合；first 只取第一行；'
+                             'best 取 --score-columns 得分最高的一行（如 Liftoff 的 coverage、sequence_ID 列）；'
+                             'aggregate 合并为一行（每列不同的值以逗号连接）')
+    parser.add_argument('--score-columns',
+                        help='--on-duplicate best 的打分列（参考文件中从1开始的列号，按优先顺序以逗号分隔，如 12,13）')
+    parser.add_argument('--query-labels', nargs='+',
+                        help='多查询模式下各查询文件的标签（用于输出前缀与宽表列名，默认取文件名去掉扩展名）')
+    parser.add_argument('--length-column', type=int,
+                        help='多查询模式下查询文件的长度列（从1开始），指定时额外输出长度宽表')
+    parser.add_argument('-j', '--jobs', '--procs', type=int, default=1,
+                        help='并行子进程数（子进程以 fork 方式共享参考索引）：多查询模式下并行处理各查询文件；'
+                             '单个查询文件时把查询文件按行切块并行连接，结果按输入顺序拼接（仅 hash 模式，'
+                             '查询文件须为未压缩的普通文件）')
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.sort_buffer < 1:
+        parser.error("--sort-buffer 必须 >= 1")
+    if args.jobs < 1:
+        parser.error("--jobs 必须 >= 1")
+    if args.engine == 'arrow':
+        try:
+            import pyarrow  # 检查可选依赖
+        except ImportError:
+            parser.error("--engine arrow 需要 pyarrow（pip install pyarrow）")
+    if args.on_duplicate == 'best':
+        if not args.score_columns:
+            parser.error("--on-duplicate best 需要指定 --score-columns")
+        try:
+            args.score_columns = [int(column) - 1 for column in args.score_columns.split(',')]
+        except ValueError:
+            parser.error(f"无法解析 --score-columns：{args.score_columns}")
+        if min(args.score_columns) < 0:
+            parser.error("--score-columns 的列号必须 >= 1")
+    if args.length_column is not None and args.length_column < 1:
+        parser.error("--length-column 必须 >= 1")
+    if args.ref_index is not None or args.compact:
+        option = "--ref-index" if args.ref_index is not None else "--compact"
+        if args.engine != 'hash':
+            parser.error(f"{option} 只支持 --engine hash")
+        if args.ref_file == '-' or not os.path.isfile(args.ref_file) or \
+                os.path.splitext(args.ref_file.lower())[1] in ('.gz', '.zst', *COLUMNAR_SUFFIXES):
+            parser.error(f"{option} 要求参考文件为未压缩的普通文本文件")
+    if args.ref_index is not None:
+        args.ref_index = args.ref_index or f"{args.ref_file}.keyidx"
+    args.query_files = args.query_file
+    args.query_file = args.query_files[0]
+    if [args.ref_file, *args.query_files].count('-') > 1:
+        parser.error("参考文件与查询文件中只能有一个为标准输入")
+    if len(args.query_files) == 1 and args.jobs > 1:
+        if args.engine != 'hash':
+            parser.error("--jobs 只支持 --engine hash")
+        if args.query_file == '-' or not os.path.isfile(args.query_file) or \
+                os.path.splitext(args.query_file.lower())[1] in ('.gz', '.zst', *COLUMNAR_SUFFIXES):
+            parser.error("--jobs 切块并行要求查询文件为未压缩的普通文本文件")
+    if len(args.query_files) > 1:
+        if args.engine != 'hash':
+            parser.error("多查询模式只支持 --engine hash")
+        if args.jobs > 1 and '-' in args.query_files:
+            parser.error("多查询并行模式下查询文件不能为标准输入")
+        args.query_labels = args.query_labels or [default_query_label(path) for path in args.query_files]
+        if len(args.query_labels) != len(args.query_files):
+            parser.error("--query-labels 的个数必须与查询文件个数相同")
+        if len(set(args.query_labels)) != len(args.query_labels):
+            parser.error(f"查询文件标签重复：{' '.join(args.query_labels)}，请用 --query-labels 指定")
     
     # 处理分隔符参数的特殊值
     if args.separator.lower() in ["tab", "t"]:
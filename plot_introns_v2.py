@@ -40,9 +40,9 @@ def normalize_chr(x):
         return v
     return v
 
-def parse_args():
+def parse_args(argv=None):
     ap = argparse.ArgumentParser(description="Plot intron length differences by chromosome (robust column detection).")
-    ap.add_argument("-i", "--input", required=True, help="Input TSV (the *.chr.tsv)")
+    ap.add_argument("-i", "--input", required=True, help="Input table (the *.chr.tsv; .parquet/.feather are read as columnar tables)")
     ap.add_argument("-o", "--output", required=True, help="Output PDF path")
     ap.add_argument("--seq-col", help="Name of sequence/chr column (optional)")
     ap.add_argument("--diff-col", help="Name of difference column (optional)")
@@ -51,16 +51,22 @@ def parse_args():
     ap.add_argument("--ylim_neg_step", type=int, default=20000, help="Step for flooring negative limit")
     ap.add_argument("--facet_all", action="store_true",
                     help="Facet by ALL unique seq values instead of forcing Chr01..Chr10")
-    return ap.parse_args()
+    return ap.parse_args(argv)
 
-def main():
-    args = parse_args()
+def main(argv=None):
+    args = parse_args(argv)
 
-    # 读入：尝试 header=0；若第一行不像表头，改用 header=None 并赋标准名
-    try:
-        df = pd.read_csv(args.input, sep="\t", header=0, dtype=str, quoting=3)
-    except Exception:
-        df = pd.read_csv(args.input, sep="\t", header=None, dtype=str, quoting=3)
+    # 读入：.parquet/.feather 直接读列式表；TSV 尝试 header=0，若第一行不像表头，改用 header=None 并赋标准名
+    suffix = args.input.lower().rsplit(".", 1)[-1]
+    if suffix == "parquet":
+        df = pd.read_parquet(args.input)
+    elif suffix == "feather":
+        df = pd.read_feather(args.input)
+    else:
+        try:
+            df = pd.read_csv(args.input, sep="\t", header=0, dtype=str, quoting=3)
+        except Exception:
+            df = pd.read_csv(args.input, sep="\t", header=None, dtype=str, quoting=3)
 
     # 列名选择
     seq_col = args.seq_col or choose_col(list(df.columns), "seq")
@@ -26,18 +26,21 @@ def main():
     ap.add_argument("--minimap2-bin", default="minimap2", help="minimap2 路径")
     ap.add_argument("--threads", type=int, default=8, help="liftoff 线程")
     ap.add_argument("--skip-plot", action="store_true", help="仅生成 TSV，不出图")
+    ap.add_argument("--cache-dir", help="GFF3 解析缓存目录（B73 统计与 intron_pipeline.py 共用；默认 {workdir}/gff.cache）")
     args = ap.parse_args()
 
     work = Path(args.workdir).expanduser().resolve()
     work.mkdir(parents=True, exist_ok=True)
+    # B73 参考注释每次运行都相同：解析结果缓存后，重跑时直接载入，不再重新解析
+    cache_dir = Path(args.cache_dir).expanduser().resolve() if args.cache_dir else work / "gff.cache"
 
     # === 1) 为 B73 注释补 intron 并统计，得到 B73.intron.exon.cds.stat.tsv ===
     b73_dir = work / "B73.ref"
     b73_dir.mkdir(exist_ok=True, parents=True)
     b73_with_intron = b73_dir / "B73.with_intron.gff3"
-    run(f"python {here/'change.gff3.add.intron.py'} -i {args.ref_gff} -o {b73_with_intron}")
-    # 统计会生成三份，目标表名为 *.intron.exon.cds.stat.tsv
-    run(f"python {here/'gff.stat.py'} -g {b73_with_intron} -p {b73_dir/'B73'}")
+    # 单次读取原始注释：补 intron 的 GFF3 作为副产物写出（供 liftoff 使用），统计会生成三份，目标表名为 *.intron.exon.cds.stat.tsv
+    run(f"python {here/'gff.stat.py'} -g {args.ref_gff} -p {b73_dir/'B73'} --add-introns --intron-gff {b73_with_intron} "
+        f"--cache-dir {cache_dir}")
     b73_feature_tsv = b73_dir / "B73.intron.exon.cds.stat.tsv"
 
     # === 2) 运行主流水线（含 liftoff + 合并 + 差值 + 作图）===
@@ -47,7 +50,7 @@ def main():
         f"--sample {args.sample} --workdir {work} "
         f"--run-liftoff --liftoff-bin {args.liftoff_bin} --minimap2-bin {args.minimap2_bin} "
         f"--target-fasta {args.target_fasta} --ref-fasta {args.ref_fasta} --ref-gff {b73_with_intron} "
-        f"--ref-feature-tsv {b73_feature_tsv} " + ("--skip-plot" if args.skip_plot else "")
+        f"--ref-feature-tsv {b73_feature_tsv} --cache-dir {cache_dir} " + ("--skip-plot" if args.skip_plot else "")
     )
     run(cmd)
 
@@ -0,0 +1,126 @@
+"""merge.file.based.on.keys.py：hash、sortmerge、arrow 三种连接方式对同一输入的输出应逐字节相同"""
+
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+SCRIPT = Path(__file__).resolve().parent.parent / "merge.file.based.on.keys.py"
+OUTPUTS = ("combine.file.tsv", "rf.unmatched.line.tsv", "rf.error.line.tsv",
+           "qf.unmatched.line.tsv", "qf.error.line.tsv", "log")
+
+# 参考文件：重复键值（含不同得分）、注释行、空行、缺少键值列的行、未被匹配的行
+REF_ROWS = [
+    "#chr\tstart\tid\tcoverage\tidentity",
+    "Chr1\t100\tG1\t0.95\t0.99",
+    "Chr1\t100\tG1\t1.00\t0.90",
+    "",
+    "Chr2\t200\tG2\t1.00\t0.98",
+    "Chr1\t300\tG3\tNA\t0.97",
+    "Chr1\t300\tG3\t0.80\t0.99",
+    "Chr2\t200\tG2\t1.00\t0.99",
+    "Chr3",
+    "Chr3\t400\tG4\t1.00\t1.00",
+    "Chr9\t900\tG9\t0.50\t0.50",
+    "  Chr2\t500\tG5\t0.70\t0.70  ",
+]
+# 查询文件：匹配、未匹配、重复查询行、注释行、空行与错误行
+QRY_ROWS = [
+    "# query",
+    "Chr1\t100\tG1\tq1",
+    "Chr2\t200\tG2\tq2",
+    "Chr1\t300\tG3\tq3",
+    "Chr2\t300\tG3\tq4",
+    "",
+    "Chr1\t100\tG1\tq5",
+    "ChrX\t1\tGX\tq6",
+    "Chr3",
+    "Chr2\t500\tG5\tq7",
+]
+
+CASES = {
+    "single_key": ["-rc", "3", "-qc", "3"],
+    "multi_key": ["-rc", "1,3", "-qc", "1,3"],
+    "key_range": ["-rc", "1-2", "-qc", "1-2"],
+    "all": ["-rc", "3", "-qc", "3", "--on-duplicate", "all"],
+    "first": ["-rc", "3", "-qc", "3", "--on-duplicate", "first"],
+    "best": ["-rc", "3", "-qc", "3", "--on-duplicate", "best", "--score-columns", "4,5"],
+    "aggregate": ["-rc", "3", "-qc", "3", "--on-duplicate", "aggregate"],
+    "multi_key_best": ["-rc", "1,3", "-qc", "1,3", "--on-duplicate", "best", "--score-columns", "5"],
+}
+
+
+def write_inputs(directory, whitespace=False):
+    def convert(rows):
+        if not whitespace:
+            return rows
+        # 制表符换成长度不一的空白
+        return [row.replace("\t", " " * (1 + i % 3)) for i, row in enumerate(rows)]
+    (directory / "ref.tsv").write_text("\n".join(convert(REF_ROWS)) + "\n")
+    (directory / "qry.tsv").write_text("\n".join(convert(QRY_ROWS)) + "\n")
+
+
+def run_engine(tmp_path, engine, options, whitespace=False, ref="ref.tsv", qry="qry.tsv"):
+    out_dir = tmp_path / engine
+    out_dir.mkdir()
+    write_inputs(out_dir, whitespace)
+    argv = [sys.executable, str(SCRIPT), "-rf", ref, "-qf", qry, "-pf", "out", "--engine", engine] + options
+    if whitespace:
+        argv += ["-sp", "whitespace"]
+    result = subprocess.run(argv, cwd=out_dir, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    return {suffix: (out_dir / f"out.{suffix}").read_bytes() for suffix in OUTPUTS}
+
+
+def engines():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return ["hash", "sortmerge"]
+    return ["hash", "sortmerge", "arrow"]
+
+
+@pytest.mark.parametrize("whitespace", [False, True], ids=["tab", "whitespace"])
+@pytest.mark.parametrize("case", sorted(CASES))
+def test_engines_identical(tmp_path, case, whitespace):
+    results = {engine: run_engine(tmp_path, engine, CASES[case], whitespace) for engine in engines()}
+    expected = results["hash"]
+    # 夹具本身须覆盖组合行与参考未匹配行
+    assert expected["combine.file.tsv"]
+    assert expected["rf.unmatched.line.tsv"].count(b"\n") > 1
+    for engine, outputs in results.items():
+        for suffix in OUTPUTS:
+            assert outputs[suffix] == expected[suffix], f"{engine}: out.{suffix}"
+
+
+def test_engines_identical_columnar(tmp_path):
+    """列式表输入（首行为表头）与同一内容的 TSV 输入结果相同"""
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+    columns = list(zip(*(row.split("\t") for row in REF_ROWS[1:] if row.count("\t") == 4 and row == row.strip())))
+    table = pa.table({
+        "chr": pa.array(columns[0]).dictionary_encode(),
+        "start": pa.array([int(v) for v in columns[1]], pa.int64()),
+        "id": pa.array(columns[2]),
+        "coverage": pa.array(columns[3]),
+        "identity": pa.array(columns[4]),
+    })
+    header = "\t".join(table.schema.names)
+    rows = [header] + ["\t".join(row) for row in zip(*columns)]
+    options = ["-rc", "1,3", "-qc", "1,3", "--on-duplicate", "best", "--score-columns", "5"]
+    for engine in engines():
+        out_dir = tmp_path / engine
+        out_dir.mkdir(parents=True)
+        (out_dir / "ref.tsv").write_text("\n".join(rows) + "\n")
+        pq.write_table(table, out_dir / "ref.parquet")
+        (out_dir / "qry.tsv").write_text("\n".join(QRY_ROWS) + "\n")
+        outputs = {}
+        for ref in ("ref.tsv", "ref.parquet"):
+            prefix = ref.replace(".", "_")
+            result = subprocess.run([sys.executable, str(SCRIPT), "-rf", ref, "-qf", "qry.tsv", "-pf", prefix,
+                                     "--engine", engine] + options, cwd=out_dir, capture_output=True, text=True)
+            assert result.returncode == 0, result.stderr
+            outputs[ref] = {suffix: (out_dir / f"{prefix}.{suffix}").read_bytes() for suffix in OUTPUTS[:-1]}
+        assert outputs["ref.tsv"]["combine.file.tsv"]
+        assert outputs["ref.parquet"] == outputs["ref.tsv"], engine